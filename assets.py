@@ -0,0 +1,102 @@
+"""
+Background asset loading.
+
+Decoding the atlas images and sounds is most of what we do before the first frame, and none of it needs the GL
+context, so it's done on a thread pool here. Things that do need the context (texture uploads, shader compiles)
+still happen on the main thread when the decoded data is used.
+
+Assets are named relative to the resource directory, and requesting the same name twice gives the same future.
+"""
+import concurrent.futures
+import os
+import threading
+import pygame
+
+from drawing import atlas_cache
+
+
+class AssetLoader(object):
+    def __init__(self, resource_dir, workers=4):
+        self.resource_dir = resource_dir
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="assets")
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.decoders = {
+            ".png": self.decode_image,
+            ".ogg": self.decode_sound,
+            ".txt": self.decode_text,
+            atlas_cache.extension: self.decode_atlas_cache,
+        }
+
+    def request(self, name):
+        """Start loading the named asset if we haven't already, and return a future for the decoded data"""
+        name = os.path.normpath(name)
+        with self.lock:
+            try:
+                return self.futures[name]
+            except KeyError:
+                pass
+            decoder = self.decoders[os.path.splitext(name)[1]]
+            future = self.executor.submit(decoder, name)
+            self.futures[name] = future
+            return future
+
+    def get(self, name):
+        """Block until the named asset is ready and return it"""
+        return self.request(name).result()
+
+    def prefetch(self, names):
+        for name in names:
+            self.request(name)
+
+    def forget(self, name):
+        """Drop our reference to a loaded asset so it can be freed. Requesting it again will decode it again"""
+        with self.lock:
+            self.futures.pop(os.path.normpath(name), None)
+
+    def progress(self):
+        """Return (finished, total) for everything requested so far"""
+        with self.lock:
+            futures = list(self.futures.values())
+        return sum(1 for future in futures if future.done()), len(futures)
+
+    def done(self):
+        finished, total = self.progress()
+        return finished == total
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def path(self, name):
+        return os.path.join(self.resource_dir, name)
+
+    def decode_image(self, name):
+        """Returns (pixels, (width, height)) ready for glTexImage2D"""
+        with open(self.path(name), "rb") as f:
+            surface = pygame.image.load(f)
+        return pygame.image.tostring(surface, "RGBA", 1), surface.get_size()
+
+    def decode_sound(self, name):
+        return pygame.mixer.Sound(self.path(name))
+
+    def decode_text(self, name):
+        with open(self.path(name), "r") as f:
+            return f.readlines()
+
+    def decode_atlas_cache(self, name):
+        try:
+            image_filename, data_filename, extra_names = atlas_cache.group(name)
+        except KeyError:
+            return None
+        cached = atlas_cache.load(self.resource_dir, image_filename, data_filename, extra_names)
+        if cached is None:
+            # No usable cache, so get started on the files it would have replaced
+            self.prefetch(atlas_cache.group_filenames(image_filename, extra_names))
+            if data_filename:
+                self.request(data_filename)
+        return cached
+
+
+def startup_assets():
+    """The assets that are needed before we can show the first frame of the game"""
+    return [atlas_cache.cache_filename(image_filename) for image_filename, _, _ in atlas_cache.atlases]
@@ -0,0 +1,83 @@
+"""
+Time the physics on its own, to see what the threaded solver buys us. This builds spaces like the game's with
+lots of packages lying about, or stacked up in columns, and steps them the way a frame does with each number of
+threads:
+
+    python benchmark_physics.py [packages] [frames]
+
+The threaded solver is only there on platforms that support it, elsewhere all the timings will be about the same.
+Sleeping is left off, since a space full of sleeping packages wouldn't give the solver anything to do.
+"""
+import random
+import sys
+import time
+import pymunk
+from globals.types import Config
+from mobile_drone import new_space
+
+# The same as the game uses
+substeps = 25
+fps = 60
+box_size = 40
+box_density = 12 / 100000
+thread_counts = [1, 2, 4]
+
+
+def new_benchmark_space(threads):
+    space = new_space(Config(physics_threads=threads))
+
+    ground = pymunk.Segment(space.static_body, (-300, 0), (12800, 0), 0.0)
+    ground.friction = 1
+    space.add(ground)
+    return space
+
+
+def add_box(space, x, y):
+    half = box_size / 2
+    vertices = [(-half, -half), (-half, half), (half, half), (half, -half)]
+    body = pymunk.Body(moment=pymunk.moment_for_poly(0.01, vertices))
+    body.position = (x, y)
+    shape = pymunk.Poly(body, vertices)
+    shape.density = box_density
+    shape.friction = 0.2
+    shape.elasticity = 0.5
+    space.add(body, shape)
+
+
+def scattered(space, num):
+    """Packages dropped all over the place, so they're mostly not touching each other"""
+    random.seed(1)
+    for i in range(num):
+        add_box(space, random.uniform(0, 12000), random.uniform(box_size, 1000))
+
+
+def stacked(space, num, height=20):
+    """Columns of packages on top of each other, which is where the solver has the most work to do"""
+    for i in range(num):
+        column, row = divmod(i, height)
+        add_box(space, column * box_size * 2, box_size * (row + 0.5))
+
+
+def run(scene, num, frames, threads):
+    space = new_benchmark_space(threads)
+    scene(space, num)
+    dt = 1.0 / fps / substeps
+    start = time.perf_counter()
+    for frame in range(frames):
+        for step in range(substeps):
+            space.step(dt)
+    return (time.perf_counter() - start) / frames
+
+
+def main(num=500, frames=300):
+    num = int(num)
+    frames = int(frames)
+    print(f"{num} packages, {frames} frames of {substeps} steps")
+    for scene in (scattered, stacked):
+        for threads in thread_counts:
+            frame_time = run(scene, num, frames, threads)
+            print(f"  {scene.__name__:<10} {threads} threads: {frame_time * 1000:7.2f}ms per frame")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -1,10 +1,22 @@
-from .quads import Quad, Line, NonAlignedQuad, QuadBuffer, LineBuffer, QuadBorder, ShadowQuadBuffer
+from .quads import (
+    Quad,
+    Line,
+    NonAlignedQuad,
+    QuadBuffer,
+    LineBuffer,
+    QuadBorder,
+    ShadowQuadBuffer,
+    StaticQuadBuffer,
+    QuadArena,
+)
 from .opengl import (
     init,
     new_frame,
     draw_all,
     draw_all_now,
+    draw_static,
     draw_ui,
+    clear_screen,
     init_drawing,
     draw_no_texture,
     draw_no_texture_now,
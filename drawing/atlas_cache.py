@@ -0,0 +1,152 @@
+"""
+Precompiled texture atlas caches.
+
+Decoding the atlas pngs (and their normal, occlude and displacement siblings) is a big chunk of our startup time,
+so this module bakes each atlas group, along with its metadata file, into a single raw file. At runtime that
+file is mmapped and the pixel data is handed straight to glTexImage2D without any decoding or copying.
+
+Rebuild the caches from the top level directory whenever the atlases change:
+
+    python -m drawing.atlas_cache
+
+Stale or missing caches are ignored and we fall back to loading the pngs, so forgetting to do that just costs
+startup time.
+"""
+import mmap
+import os
+import struct
+import sys
+import numpy
+
+# magic, version, width, height, number of images, metadata length
+header = struct.Struct("<4sIIIII")
+magic = b"MDAT"
+version = 1
+alignment = 16
+extension = ".atlascache"
+
+# image filename, metadata filename, whether it has normal/occlude/displace siblings
+atlases = [
+    ("atlas_0.png", "atlas.txt", True),
+    ("ground_atlas_0.png", "ground_atlas.txt", True),
+    ("cursor_atlas_0.png", "cursor_atlas.txt", False),
+    (os.path.join("fonts", "petscii.png"), None, False),
+]
+
+
+def group_filenames(image_filename, extra_names=True):
+    """The list of image files that make up an atlas group, with the diffuse image first"""
+    filenames = [image_filename]
+    if extra_names:
+        for extra in ("_normal", "_occlude", "_displace"):
+            filenames.append(image_filename[:-4] + extra + image_filename[-4:])
+    return filenames
+
+
+def cache_filename(image_filename):
+    return image_filename[:-4] + extension
+
+
+def group(name):
+    """Find the entry in the atlases table that a cache file name belongs to"""
+    name = os.path.normpath(name)
+    for entry in atlases:
+        if os.path.normpath(cache_filename(entry[0])) == name:
+            return entry
+    raise KeyError(name)
+
+
+def aligned(offset):
+    return (offset + alignment - 1) & ~(alignment - 1)
+
+
+class AtlasCache(object):
+    """
+    A memory mapped atlas cache. The images are numpy views directly onto the mapping in the same bottom-up RGBA
+    layout that pygame.image.tostring gives us, so they can go straight to the driver
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        tag, file_version, self.width, self.height, count, metadata_length = header.unpack_from(self.map, 0)
+        if tag != magic or file_version != version:
+            raise ValueError(f"{filename} is not a version {version} atlas cache")
+
+        offset = header.size
+        self.metadata = self.map[offset : offset + metadata_length].decode("utf8").splitlines()
+        offset = aligned(offset + metadata_length)
+
+        image_size = self.width * self.height * 4
+        if offset + image_size * count > len(self.map):
+            raise ValueError(f"{filename} is truncated")
+
+        self.images = []
+        for i in range(count):
+            self.images.append(numpy.frombuffer(self.map, numpy.uint8, image_size, offset))
+            offset += image_size
+
+
+def source_filenames(resource_dir, image_filename, data_filename, extra_names):
+    filenames = [os.path.join(resource_dir, name) for name in group_filenames(image_filename, extra_names)]
+    if data_filename:
+        filenames.append(os.path.join(resource_dir, data_filename))
+    return filenames
+
+
+def load(resource_dir, image_filename, data_filename, extra_names=True):
+    """Return the AtlasCache for an atlas group if there's one that's up to date, otherwise None"""
+    filename = os.path.join(resource_dir, cache_filename(image_filename))
+    try:
+        cache_time = os.path.getmtime(filename)
+        for source in source_filenames(resource_dir, image_filename, data_filename, extra_names):
+            if os.path.getmtime(source) > cache_time:
+                return None
+        cached = AtlasCache(filename)
+    except (OSError, ValueError, struct.error):
+        return None
+
+    if len(cached.images) != len(group_filenames(image_filename, extra_names)):
+        return None
+    return cached
+
+
+def build(resource_dir, image_filename, data_filename, extra_names=True):
+    """Decode an atlas group and write it out as a cache file. Returns the name of the file written"""
+    import pygame
+
+    images = []
+    size = None
+    for name in group_filenames(image_filename, extra_names):
+        with open(os.path.join(resource_dir, name), "rb") as f:
+            surface = pygame.image.load(f)
+        if size is None:
+            size = surface.get_size()
+        elif surface.get_size() != size:
+            raise TypeError(f"Invalid texture sizes in {image_filename} group")
+        images.append(pygame.image.tostring(surface, "RGBA", 1))
+
+    metadata = b""
+    if data_filename:
+        with open(os.path.join(resource_dir, data_filename), "rb") as f:
+            metadata = f.read()
+
+    filename = os.path.join(resource_dir, cache_filename(image_filename))
+    with open(filename, "wb") as f:
+        f.write(header.pack(magic, version, size[0], size[1], len(images), len(metadata)))
+        f.write(metadata)
+        f.write(b"\0" * (aligned(header.size + len(metadata)) - header.size - len(metadata)))
+        for image in images:
+            f.write(image)
+
+    return filename
+
+
+def main(resource_dir="resource"):
+    for image_filename, data_filename, extra_names in atlases:
+        print("Built", build(resource_dir, image_filename, data_filename, extra_names))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
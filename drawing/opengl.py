@@ -1,5 +1,7 @@
+import ctypes
 import drawing
 import os
+import numpy
 
 from OpenGL.arrays import numpymodule
 from OpenGL.GL import *
@@ -219,7 +221,13 @@ class State(object):
 
 
 class UIBuffers(object):
-    """Simple storage for ui_buffers that need to be drawn at the end of the frame after the scene has been fully rendered"""
+    """
+    Storage for ui_buffers that need to be drawn at the end of the frame after the scene has been fully rendered.
+
+    Rather than drawing them one at a time, everything added in a frame is gathered into a single vertex stream
+    with any translation and scale baked in, and untextured quads flagged per vertex, so that it can all go out
+    in a draw call per texture. In practice that's the font atlas and the cursor atlas, so two
+    """
 
     def __init__(self):
         self.reset()
@@ -229,22 +237,88 @@ class UIBuffers(object):
             local_state = (state.pos, state.scale)
         else:
             local_state = None
-        if texture is not None:
-            self.buffers.append(((quad_buffer, texture, default_shader), local_state, draw_all_now))
-        else:
-            self.buffers.append(((quad_buffer, default_shader), local_state, draw_no_texture_now))
+        self.buffers.append((quad_buffer, texture, local_state))
 
     def reset(self):
         self.buffers = []
 
+    def gather(self):
+        """
+        Returns the arrays for the merged stream, along with the list of (texture, draw_type, start, count) runs
+        to draw it with. A new run is only started when the texture or primitive type changes
+        """
+        vertices, tcs, colours, textured = [], [], [], []
+        runs = []
+        start = 0
+        for quad_buffer, texture, local_state in self.buffers:
+            count = quad_buffer.current_size
+            if count == 0:
+                continue
+            pos, scale = local_state if local_state else (state.pos, state.scale)
+            indices = quad_buffer.indices[:count]
+            vertex = quad_buffer.vertex_data[indices]
+            vertex[:, 0] = (vertex[:, 0] + pos.x) * scale.x
+            vertex[:, 1] = (vertex[:, 1] + pos.y) * scale.y
+            vertices.append(vertex)
+            colours.append(quad_buffer.colour_data[indices])
+            if texture is not None:
+                tcs.append(quad_buffer.tc_data[indices])
+                textured.append(numpy.ones(count, numpy.float32))
+            else:
+                tcs.append(numpy.zeros((count, 2), numpy.float32))
+                textured.append(numpy.zeros(count, numpy.float32))
+
+            draw_type = quad_buffer.draw_type
+            if runs:
+                run_texture, run_type, run_start, run_count = runs[-1]
+                if run_type == draw_type and (texture is None or run_texture in (None, texture)):
+                    run_texture = run_texture if texture is None else texture
+                    runs[-1] = (run_texture, run_type, run_start, run_count + count)
+                    start += count
+                    continue
+            runs.append((texture, draw_type, start, count))
+            start += count
+
+        if not runs:
+            return None, runs
+        return (
+            numpy.concatenate(vertices),
+            numpy.concatenate(tcs),
+            numpy.concatenate(colours),
+            numpy.concatenate(textured),
+        ), runs
+
     def draw(self):
-        for args, local_state, func in self.buffers:
-            if local_state:
-                state.update(*local_state)
+        arrays, runs = self.gather()
+        if not runs:
+            return
+        vertex_data, tc_data, colour_data, textured_data = arrays
+        shader = default_shader
+        # Everything has its transform baked in already
+        state.update(Point(0.0, 0.0), Point(1.0, 1.0))
+        glUniform1i(shader.locations.using_textures, 0)
+
+        glEnableVertexAttribArray(shader.locations.vertex_data)
+        glEnableVertexAttribArray(shader.locations.tc_data)
+        glEnableVertexAttribArray(shader.locations.colour_data)
+        glEnableVertexAttribArray(shader.locations.textured_data)
+
+        glVertexAttribPointer(shader.locations.vertex_data, 3, GL_FLOAT, GL_FALSE, 0, vertex_data)
+        glVertexAttribPointer(shader.locations.tc_data, 2, GL_FLOAT, GL_FALSE, 0, tc_data)
+        glVertexAttribPointer(shader.locations.colour_data, 4, GL_FLOAT, GL_FALSE, 0, colour_data)
+        glVertexAttribPointer(shader.locations.textured_data, 1, GL_FLOAT, GL_FALSE, 0, textured_data)
 
-            func(*args)
-            if local_state:
-                state.update()
+        glActiveTexture(GL_TEXTURE0)
+        for texture, draw_type, start, count in runs:
+            if texture is not None:
+                glBindTexture(GL_TEXTURE_2D, texture.texture)
+            glDrawArrays(draw_type, start, count)
+
+        glDisableVertexAttribArray(shader.locations.vertex_data)
+        glDisableVertexAttribArray(shader.locations.tc_data)
+        glDisableVertexAttribArray(shader.locations.colour_data)
+        glDisableVertexAttribArray(shader.locations.textured_data)
+        state.update()
 
 
 z_max = 10000
@@ -256,6 +330,11 @@ state = State(geom_shader)
 ui_buffers = UIBuffers()
 gbuffer = None
 shadow_buffer = None
+# Set by the quality governor. max_cone_lights of None means no limit
+shadow_samples = 512
+max_cone_lights = None
+# Goes up whenever every cached shadow row needs drawing again
+shadow_generation = 0
 
 
 def init(w, h):
@@ -308,7 +387,7 @@ def init(w, h):
     default_shader.load(
         "default",
         uniforms=("tex", "translation", "scale", "screen_dimensions", "using_textures"),
-        attributes=("vertex_data", "tc_data", "colour_data"),
+        attributes=("vertex_data", "tc_data", "colour_data", "textured_data"),
     )
 
     shadow_shader.load(
@@ -322,6 +401,7 @@ def init(w, h):
             "screen_dimensions",
             "light_dimensions",
             "light_pos",
+            "shadow_samples",
         ),
         attributes=("vertex_data",),
     )
@@ -342,6 +422,27 @@ def init(w, h):
     glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
 
+def set_quality(samples, max_lights):
+    global shadow_samples, max_cone_lights, shadow_generation
+    shadow_samples = samples
+    max_cone_lights = max_lights
+    # Any cached shadow rows were drawn at the old quality
+    shadow_generation += 1
+
+
+def active_cone_lights():
+    """The cone lights we have the budget to draw, keeping the ones nearest the middle of the screen"""
+    if max_cone_lights is None or len(globals.cone_lights) <= max_cone_lights:
+        return globals.cone_lights
+    centre = globals.screen * 0.5
+
+    def distance(light):
+        x, y = light.screen_pos[:2]
+        return (x - centre.x) ** 2 + (y - centre.y) ** 2
+
+    return sorted(globals.cone_lights, key=distance)[:max_cone_lights]
+
+
 def reset_state():
     state.reset()
 
@@ -380,6 +481,15 @@ def end_frame():
     # ui_buffers.draw()
 
 
+def clear_screen():
+    """Start a frame that only draws ui straight to the screen, such as the loading screen"""
+    ui_buffers.reset()
+    glBindFramebuffer(GL_DRAW_FRAMEBUFFER, 0)
+    glDisable(GL_DEPTH_TEST)
+    glClearColor(0.0, 0.0, 0.0, 1.0)
+    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+
 def draw_ui():
     default_shader.use()
     glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
@@ -399,10 +509,11 @@ def end_frame_game_mode():
 
     gbuffer.bind_for_reading()
     shadow_buffer.bind_for_writing()
-    glClearColor(0.0, 0.0, 1.0, 1.0)
-    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    # The shadow map isn't cleared, because lights with static shadows keep their rows from earlier frames. Every
+    # row that's in use is either drawn again below or still valid, and each row is drawn over completely
     # Create the shadow maps...
     shadow_shader.use()
+    glUniform1f(shadow_shader.locations.shadow_samples, shadow_samples)
 
     # do the mouse light
     glUniform2f(shadow_shader.locations.light_pos, *(globals.mouse_screen))
@@ -415,7 +526,11 @@ def end_frame_game_mode():
     glDrawElements(GL_QUADS, 4, GL_UNSIGNED_INT, quad_buffer.indices)
 
     # Now do the other lights with shadows
-    for light in itertools.chain(globals.lights, globals.cone_lights):
+    for light in itertools.chain(globals.lights, active_cone_lights()):
+        if light.static_shadow:
+            if light.shadow_valid:
+                continue
+            light.shadow_valid = True
         glUniform2f(shadow_shader.locations.light_pos, *light.screen_pos[:2])
         # glVertexAttribPointer( shadow_shader.locations.vertex_data, 3, GL_FLOAT, GL_FALSE, 0, quad_buffer.vertex_data )
         glDrawElements(GL_QUADS, 4, GL_UNSIGNED_INT, quad_buffer.indices[light.shadow_index * 4 :])
@@ -508,7 +623,7 @@ def end_frame_game_mode():
     glUniform1f(light_shader.locations.light_radius, 400)
     glUniform1f(light_shader.locations.light_intensity, 1)
 
-    for light in globals.cone_lights:
+    for light in active_cone_lights():
         if not light.on:
             continue
 
@@ -639,6 +754,102 @@ def draw_all_now_normals(quad_buffer, texture, shader):
     glDisableVertexAttribArray(shader.locations.colour_data)
 
 
+def upload_static(quad_buffer):
+    """
+    (Re)upload the used part of a StaticQuadBuffer into its buffer objects. The element buffer is ordered by
+    fixed-width buckets along x so that the quads in any stretch of x are one contiguous range of it
+    """
+    if quad_buffer.vbos is None:
+        quad_buffer.vbos = glGenBuffers(4)
+    size = quad_buffer.current_size
+    vertex_vbo, tc_vbo, colour_vbo, index_vbo = quad_buffer.vbos
+    for vbo, data in (
+        (vertex_vbo, quad_buffer.vertex_data),
+        (tc_vbo, quad_buffer.tc_data),
+        (colour_vbo, quad_buffer.colour_data),
+    ):
+        glBindBuffer(GL_ARRAY_BUFFER, vbo)
+        glBufferData(GL_ARRAY_BUFFER, data[:size], GL_STATIC_DRAW)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    num_points = quad_buffer.num_points
+    live = numpy.ones(size // num_points, bool)
+    live[[index // num_points for index in quad_buffer.vacant]] = False
+    quads = numpy.flatnonzero(live)
+    xs = quad_buffer.vertex_data[:size, 0].reshape(-1, num_points)[quads]
+    min_x = xs.min(axis=1)
+    buckets = numpy.floor(min_x / quad_buffer.bucket_width)
+    # Within a bucket they stay in the order they were made in, which is the order they used to be drawn in
+    order = numpy.lexsort((quads, buckets))
+    quad_buffer.buckets = buckets[order]
+    quad_buffer.max_width = float((xs.max(axis=1) - min_x).max()) if len(quads) else 0
+    indices = (quads[order, None] * num_points + numpy.arange(num_points)).astype(numpy.uint32).ravel()
+    quad_buffer.num_indices = len(indices)
+
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, index_vbo)
+    glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices, GL_STATIC_DRAW)
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+    quad_buffer.dirty = False
+
+
+def static_range(quad_buffer, left, right):
+    """The (first, count) range of the element buffer for the quads that could be visible between left and right"""
+    if left is None:
+        return 0, quad_buffer.num_indices
+    # A quad's bucket is from its left edge, so look back far enough to find ones that stick out into the view
+    first_bucket = numpy.floor((left - quad_buffer.max_width) / quad_buffer.bucket_width)
+    last_bucket = numpy.floor(right / quad_buffer.bucket_width)
+    first = numpy.searchsorted(quad_buffer.buckets, first_bucket, "left")
+    last = numpy.searchsorted(quad_buffer.buckets, last_bucket, "right")
+    return int(first) * quad_buffer.num_points, int(last - first) * quad_buffer.num_points
+
+
+def draw_static(quad_buffer, texture, left=None, right=None):
+    """
+    Draw a StaticQuadBuffer in the geometry pass. The data stays on the GPU between frames, and only the camera
+    transform changes. If given the world x range that's in view, only the quads near it are drawn
+    """
+    if quad_buffer.dirty:
+        upload_static(quad_buffer)
+    first, count = static_range(quad_buffer, left, right)
+    if count == 0:
+        return
+
+    shader = geom_shader
+    vertex_vbo, tc_vbo, colour_vbo, index_vbo = quad_buffer.vbos
+    glActiveTexture(GL_TEXTURE0)
+    glBindTexture(GL_TEXTURE_2D, texture.texture)
+    glActiveTexture(GL_TEXTURE1)
+    glBindTexture(GL_TEXTURE_2D, texture.normal_texture)
+    glActiveTexture(GL_TEXTURE2)
+    glBindTexture(GL_TEXTURE_2D, texture.occlude_texture)
+    glActiveTexture(GL_TEXTURE3)
+    glBindTexture(GL_TEXTURE_2D, texture.displacement_texture)
+
+    glUniform1i(shader.locations.using_textures, 1)
+
+    attributes = (
+        (shader.locations.vertex_data, 3, vertex_vbo),
+        (shader.locations.tc_data, 2, tc_vbo),
+        (shader.locations.normal_data, 2, tc_vbo),
+        (shader.locations.occlude_data, 2, tc_vbo),
+        (shader.locations.displace_data, 2, tc_vbo),
+        (shader.locations.colour_data, 4, colour_vbo),
+    )
+    for location, size, vbo in attributes:
+        glEnableVertexAttribArray(location)
+        glBindBuffer(GL_ARRAY_BUFFER, vbo)
+        glVertexAttribPointer(location, size, GL_FLOAT, GL_FALSE, 0, None)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, index_vbo)
+    glDrawElements(GL_QUADS, count, GL_UNSIGNED_INT, ctypes.c_void_p(first * 4))
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+    for location, size, vbo in attributes:
+        glDisableVertexAttribArray(location)
+
+
 def draw_all_now(quad_buffer, texture, shader):
     # This is a copy paste from the above function, but this is the inner loop of the program, and we need it to be fast.
     # I'm not willing to put conditionals around the normal lines, so I made a copy of the function without them
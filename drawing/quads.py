@@ -1,4 +1,6 @@
 import numpy
+import bisect
+import heapq
 import drawing
 import globals
 from globals.types import Point
@@ -21,13 +23,14 @@ class ShapeBuffer(object):
         self.colour_data = numpy.ones(
             (size * self.num_points, 4), numpy.float32
         )  # RGBA default is white opaque
-        self.indices = numpy.zeros(size * self.num_points, numpy.uint32)
+        self.indices = numpy.arange(size * self.num_points, dtype=numpy.uint32)
         self.size = size
-        for i in range(size * self.num_points):
-            self.indices[i] = i
+        self.start = 0
         self.current_size = 0
         self.max_size = size * self.num_points
         self.vacant = set()
+        # Set whenever anything in the buffer changes. Only buffers that live on the GPU care
+        self.dirty = True
 
     def next(self):
         """
@@ -36,16 +39,15 @@ class ShapeBuffer(object):
 
         FIXME: Implement resizing when full
         """
+        self.dirty = True
         if len(self.vacant) > 0:
             # for a vacant one we blatted the indices, so we should reset those...
             out = self.vacant.pop()
-            for i in range(self.num_points):
-                self.indices[out + i] = out + i
-                for j in range(4):
-                    self.colour_data[out + i][j] = 1
+            self.indices[out : out + self.num_points] = numpy.arange(out, out + self.num_points)
+            self.colour_data[out : out + self.num_points] = 1
             return out
 
-        out = self.current_size
+        out = self.start + self.current_size
         self.current_size += self.num_points
         if self.current_size > self.max_size:
             raise NotImplemented
@@ -60,9 +62,9 @@ class ShapeBuffer(object):
         In the future we could keep track of child quads and update them ourselves, but right now that is too
         much overhead
         """
+        self.dirty = True
         self.current_size = n
-        for i in range(self.size * self.num_points):
-            self.indices[i] = i
+        self.indices[:] = numpy.arange(self.size * self.num_points)
         self.colour_data = numpy.ones((self.max_size, 4), numpy.float32)  # RGBA default is white opaque
         self.vacant = set()
 
@@ -73,11 +75,10 @@ class ShapeBuffer(object):
         because the game is so simple I'm hoping it won't ever be an issue
 
         """
+        self.dirty = True
         self.vacant.add(index)
-        for i in range(self.num_points):
-            self.indices[index + i] = 0
-            for j in range(3):
-                self.vertex_data[index + i][j] = 0
+        self.indices[index : index + self.num_points] = 0
+        self.vertex_data[index : index + self.num_points] = 0
 
 
 class QuadBuffer(ShapeBuffer):
@@ -110,11 +111,197 @@ class QuadBuffer(ShapeBuffer):
         self.indices = new_indices
 
 
+class QuadBufferRange(QuadBuffer):
+    """
+    A contiguous run of quads handed out by a QuadArena from one of its shared buffers. It can be used anywhere
+    a QuadBuffer can, both for allocating quads and drawing them; the quads' indices are into the shared arrays
+    and drawing only covers our slice of the index array
+    """
+
+    def __init__(self, arena, buffer, start, size):
+        self.arena = arena
+        self.buffer = buffer
+        self.is_ui = buffer.is_ui
+        self.mouse_relative = buffer.mouse_relative
+        self.vertex_data = buffer.vertex_data
+        self.tc_data = buffer.tc_data
+        self.colour_data = buffer.colour_data
+        self.size = size
+        self.start = start * self.num_points
+        self.current_size = 0
+        self.max_size = size * self.num_points
+        self.vacant = set()
+        self.dirty = True
+
+    @property
+    def indices(self):
+        return self.buffer.indices[self.start : self.start + self.current_size]
+
+    # Quad indices are offsets into the shared arrays, but our indices property is a slice that begins at our
+    # start, so these go through the shared buffer's indices instead
+
+    def next(self):
+        self.dirty = True
+        if len(self.vacant) > 0:
+            out = self.vacant.pop()
+            self.buffer.indices[out : out + self.num_points] = numpy.arange(out, out + self.num_points)
+            self.colour_data[out : out + self.num_points] = 1
+            return out
+
+        if self.current_size + self.num_points > self.max_size:
+            raise ValueError(f"Out of quads, this range only has {self.size}")
+        out = self.start + self.current_size
+        self.current_size += self.num_points
+        return out
+
+    def remove_shape(self, index):
+        self.dirty = True
+        self.vacant.add(index)
+        self.buffer.indices[index : index + self.num_points] = 0
+        self.vertex_data[index : index + self.num_points] = 0
+
+    def truncate(self, n):
+        self.dirty = True
+        self.current_size = n
+        first, last = self.start, self.start + self.max_size
+        self.buffer.indices[first:last] = numpy.arange(first, last)
+        self.colour_data[first:last] = 1
+        self.vacant = set()
+
+    def delete(self):
+        self.arena.free(self)
+
+
+class QuadArena(object):
+    """
+    Hands out QuadBufferRanges from a few large shared QuadBuffers, so that things like text boxes that come and
+    go a lot don't each have to allocate a set of buffers of their own. Each shared buffer keeps a sorted list of
+    its free (start, size) runs, in quads, and freed runs are merged with their neighbours
+    """
+
+    def __init__(self, block_size, ui=False, mouse_relative=False):
+        self.block_size = block_size
+        self.ui = ui
+        self.mouse_relative = mouse_relative
+        self.buffers = []
+        self.free_lists = []
+
+    def allocate(self, size):
+        size = max(size, 1)
+        for buffer, free_list in zip(self.buffers, self.free_lists):
+            for i, (start, length) in enumerate(free_list):
+                if length >= size:
+                    break
+            else:
+                continue
+            if length == size:
+                del free_list[i]
+            else:
+                free_list[i] = (start + size, length - size)
+            break
+        else:
+            buffer = QuadBuffer(max(self.block_size, size), ui=self.ui, mouse_relative=self.mouse_relative)
+            self.buffers.append(buffer)
+            self.free_lists.append([(size, buffer.size - size)] if buffer.size > size else [])
+            start = 0
+
+        # Whatever used this run before may have left its indices zeroed out and its colours changed
+        first, last = start * buffer.num_points, (start + size) * buffer.num_points
+        buffer.indices[first:last] = numpy.arange(first, last)
+        buffer.colour_data[first:last] = 1
+        return QuadBufferRange(self, buffer, start, size)
+
+    def free(self, quad_range):
+        free_list = self.free_lists[self.buffers.index(quad_range.buffer)]
+        start, size = quad_range.start // quad_range.num_points, quad_range.size
+        i = bisect.bisect_left(free_list, (start, size))
+        free_list.insert(i, (start, size))
+        # Merge with the following run and then the previous one
+        if i + 1 < len(free_list) and start + size == free_list[i + 1][0]:
+            free_list[i] = (start, size + free_list[i + 1][1])
+            del free_list[i + 1]
+        if i > 0 and free_list[i - 1][0] + free_list[i - 1][1] == start:
+            free_list[i - 1] = (free_list[i - 1][0], free_list[i - 1][1] + free_list[i][1])
+            del free_list[i]
+
+
+class StaticQuadBuffer(QuadBuffer):
+    """
+    A QuadBuffer for world geometry that never moves. It's kept on the GPU in buffer objects by
+    drawing.draw_static, and only uploaded again when one of its quads has changed, so drawing it each frame costs
+    the same however much of it there is
+    """
+
+    # Width in world units of the buckets that the quads are sorted into for culling
+    bucket_width = 256
+
+    def __init__(self, size):
+        super(StaticQuadBuffer, self).__init__(size)
+        self.vbos = None
+        self.buckets = None
+        self.max_width = 0
+        self.num_indices = 0
+
+
 class ShadowQuadBuffer(QuadBuffer):
-    def new_light(self):
+    """
+    Each light with a shadow gets a row of the shadow map, and a quad at the same position in here to draw it.
+    Deleted lights give their rows back, and new lights get the lowest free row, so the rows in use stay packed
+    at the bottom of the map however many lights come and go
+    """
+
+    def __init__(self, size, rows=None):
+        super(ShadowQuadBuffer, self).__init__(size)
+        # There can't be more lights than there are rows in the shadow map texture
+        self.rows = size if rows is None else min(size, rows)
+        self.free_heap = []
+        self.free_rows = set()
+
+    def next(self):
+        self.dirty = True
+        while self.free_heap:
+            row = heapq.heappop(self.free_heap)
+            if row not in self.free_rows:
+                # Already trimmed off the top
+                continue
+            self.free_rows.remove(row)
+            out = row * self.num_points
+            self.vacant.discard(out)
+            self.indices[out : out + self.num_points] = numpy.arange(out, out + self.num_points)
+            self.colour_data[out : out + self.num_points] = 1
+            return out
+
         row = self.current_size // self.num_points
+        if row >= self.rows:
+            raise ValueError(f"Out of shadow map rows, there are only {self.rows}")
+        self.current_size += self.num_points
+        return row * self.num_points
+
+    def remove_shape(self, index):
+        super(ShadowQuadBuffer, self).remove_shape(index)
+        row = index // self.num_points
+        self.free_rows.add(row)
+        heapq.heappush(self.free_heap, row)
+
+        # Free rows at the top can just go
+        while self.current_size and (self.current_size // self.num_points) - 1 in self.free_rows:
+            self.current_size -= self.num_points
+            self.free_rows.remove(self.current_size // self.num_points)
+            self.vacant.discard(self.current_size)
+
+    def truncate(self, n):
+        super(ShadowQuadBuffer, self).truncate(n)
+        self.free_heap = []
+        self.free_rows = set()
+
+    @property
+    def active_rows(self):
+        return self.current_size // self.num_points - len(self.free_rows)
+
+    def new_light(self):
         light = Quad(self)
-        # Now set the vertices for the next line ...
+        row = light.index // self.num_points
+        # Now set the vertices for the row ...
         bl = Point(0, row)
         tr = Point(globals.screen.x, row + 1)
         light.set_vertices(bl, tr, 0)
@@ -171,6 +358,7 @@ class Shape(object):
             self.vertex[0 : self.num_points] = vertex
         if tc is not None:
             self.tc[0 : self.num_points] = tc
+        source.dirty = True
         self.old_vertices = None
         self.deleted = False
         self.enabled = True
@@ -193,6 +381,7 @@ class Shape(object):
         if self.deleted:
             return
         self.enabled = False
+        self.source.dirty = True
         if self.old_vertices is None:
             self.old_vertices = numpy.copy(self.vertex[0 : self.num_points])
             for i in range(self.num_points):
@@ -205,6 +394,7 @@ class Shape(object):
         if self.deleted:
             return
         self.enabled = True
+        self.source.dirty = True
         if self.old_vertices is not None:
             for i in range(self.num_points):
                 self.vertex[i] = self.old_vertices[i]
@@ -213,6 +403,7 @@ class Shape(object):
     def set_vertices(self, bl, tr, z):
         if self.deleted:
             return
+        self.source.dirty = True
         self.setvertices(self.vertex, bl, tr, z)
         if self.old_vertices is not None:
             self.old_vertices = numpy.copy(self.vertex[0 : self.num_points])
@@ -222,6 +413,7 @@ class Shape(object):
     def set_all_vertices(self, vertices, z):
         if self.deleted:
             return
+        self.source.dirty = True
         setallvertices(self, self.vertex, vertices, z)
         if self.old_vertices is not None:
             self.old_vertices = numpy.copy(self.vertex[0 : self.num_points])
@@ -232,6 +424,7 @@ class Shape(object):
         return (Point(self.vertex[0][0], self.vertex[0][1]) + Point(self.vertex[2][0], self.vertex[2][1])) / 2
 
     def translate(self, amount):
+        self.source.dirty = True
         if self.old_vertices is not None:
             vertices = self.old_vertices
         else:
@@ -243,16 +436,19 @@ class Shape(object):
     def set_colour(self, colour):
         if self.deleted:
             return
+        self.source.dirty = True
         self.setcolour(self.colour, colour)
 
     def set_colours(self, colours):
         if self.deleted:
             return
+        self.source.dirty = True
         for current, target in zip(self.colour, colours):
             for i in range(self.num_points):
                 current[i] = target[i]
 
     def set_texture_coordinates(self, tc):
+        self.source.dirty = True
         self.tc[0 : self.num_points] = tc
 
 
@@ -304,6 +500,61 @@ def setcoloursline(self, colour, values):
             colour[i][j] = values[i][j]
 
 
+def quad_vertex_indices(quads):
+    """The index of every vertex of the given quads as an (n, 4) array, for fancy indexing into their buffer"""
+    return numpy.array([quad.index for quad in quads], numpy.uint32)[:, None] + numpy.arange(4)
+
+
+def set_quads_vertices(quads, bl, tr, z):
+    """
+    Set the vertices of a list of quads that all come from the same buffer with one write, rather than one
+    set_vertices call each. bl and tr are (n, 2) arrays
+    """
+    vertices = numpy.empty((len(quads), 4, 3), numpy.float32)
+    # Same order as setverticesquad
+    vertices[:, 0, :2] = bl
+    vertices[:, 1, 0] = bl[:, 0]
+    vertices[:, 1, 1] = tr[:, 1]
+    vertices[:, 2, :2] = tr
+    vertices[:, 3, 0] = tr[:, 0]
+    vertices[:, 3, 1] = bl[:, 1]
+    vertices[:, :, 2] = z
+    set_quads_all_vertices(quads, vertices)
+
+
+def set_quads_all_vertices(quads, vertices):
+    """
+    The bulk version of set_all_vertices. vertices is an (n, 4, 3) array for the n quads, which must all come
+    from the same buffer. As with set_vertices, disabled quads have their new vertices stashed away for when
+    they're enabled again, and deleted ones are left alone
+    """
+    live = numpy.array([not quad.deleted for quad in quads], bool)
+    if not live.all():
+        quads = [quad for quad, on in zip(quads, live) if on]
+        vertices = vertices[live]
+    if not quads:
+        return
+
+    enabled = numpy.array([quad.old_vertices is None for quad in quads])
+    for i in numpy.flatnonzero(~enabled):
+        quads[i].old_vertices = vertices[i]
+    quads[0].source.dirty = True
+    if enabled.all():
+        quads[0].source.vertex_data[quad_vertex_indices(quads)] = vertices
+    elif enabled.any():
+        live = [quad for quad, on in zip(quads, enabled) if on]
+        quads[0].source.vertex_data[quad_vertex_indices(live)] = vertices[enabled]
+
+
+def set_quads_colour(quads, colour):
+    """Set the colour of a list of quads that all come from the same buffer with one write"""
+    quads = [quad for quad in quads if not quad.deleted]
+    if not quads:
+        return
+    quads[0].source.dirty = True
+    quads[0].source.colour_data[quad_vertex_indices(quads)] = colour
+
+
 class Quad(Shape):
     num_points = 4
     setvertices = setverticesquad
@@ -5,12 +5,14 @@ uniform sampler2D tex;
 uniform int using_textures;
 in vec2 texcoord;
 in vec4 colour;
+in float textured;
 
 out vec4 out_colour;
 
 void main()
 {
-    if(1 == using_textures) {
+    // The ui batcher flags textured quads per vertex, everything else sets the uniform
+    if(1 == using_textures || textured > 0.5) {
         out_colour = texture(tex, texcoord)*colour;
     }
     else {
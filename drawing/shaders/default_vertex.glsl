@@ -6,9 +6,11 @@ uniform vec2 scale;
 in vec3 vertex_data;
 in vec2 tc_data;
 in vec4 colour_data;
+in float textured_data;
 
 out vec2 texcoord;
 out vec4 colour;
+out float textured;
 
 void main()
 {
@@ -18,4 +20,5 @@ void main()
                         1.0) ;
     texcoord    = tc_data;
     colour      = colour_data;
+    textured    = textured_data;
 }
@@ -9,6 +9,7 @@ uniform vec3 screen_dimensions;
 
 uniform vec2 light_pos;
 uniform vec2 light_dimensions;
+uniform float shadow_samples;
 out vec4 out_colour;
 
 #define PI 3.14159
@@ -25,9 +26,9 @@ void main()
     vec2 lp = light_pos/screen_dimensions.xy;
     vec2 tc = CalcTexCoord();
 
-    for(float y=0.0; y < 512; y += 1.0) {
+    for(float y=0.0; y < shadow_samples; y += 1.0) {
         float theta = ((gl_FragCoord.x*2.0)/sb_dimensions.x)-1;
-        float r = y/512;
+        float r = y/shadow_samples;
         theta = PI*1.5 + theta*PI;
 
         vec2 coord = vec2(-r * sin(theta), -r * cos(theta));
@@ -13,6 +13,7 @@ from . import constants
 from . import quads
 from . import opengl
 from . import sprite
+from . import atlas_cache
 
 from globals.types import Point
 
@@ -21,17 +22,21 @@ global_scale = 1
 
 
 class TextureImage(object):
-    """Load a file into a gltexture and store that texture for later use"""
+    """
+    Load a file into a gltexture and store that texture for later use. If the pixels have already been decoded
+    (from an atlas cache for example) they can be passed in along with their size to skip loading the file
+    """
 
-    def __init__(self, filename):
+    def __init__(self, filename, pixels=None, size=None):
         filename = os.path.join(globals.dirs.resource, filename)
         if filename not in cache:
-            with open(filename, "rb") as f:
-                self.textureSurface = pygame.image.load(f)
-            self.textureData = pygame.image.tostring(self.textureSurface, "RGBA", 1)
-
-            self.width = self.textureSurface.get_width()
-            self.height = self.textureSurface.get_height()
+            if pixels is None:
+                with open(filename, "rb") as f:
+                    surface = pygame.image.load(f)
+                pixels = pygame.image.tostring(surface, "RGBA", 1)
+                size = surface.get_size()
+            self.textureData = pixels
+            self.width, self.height = size
 
             self.texture = glGenTextures(1)
             cache[filename] = (self.texture, self.width, self.height)
@@ -67,12 +72,17 @@ class Texture(object):
         normal_filename: Optional[str] = None,
         occlusion_filename: Optional[str] = None,
         displacement_filename: Optional[str] = None,
+        images: Optional[list] = None,
     ):
         self.filenames = [filename]
         for fname in normal_filename, occlusion_filename, displacement_filename:
             if fname:
                 self.filenames.append(fname)
-        self.textures = [TextureImage(filename) for filename in self.filenames]
+        if images is None:
+            images = [(None, None)] * len(self.filenames)
+        self.textures = [
+            TextureImage(filename, pixels, size) for filename, (pixels, size) in zip(self.filenames, images)
+        ]
         # They need to all be the same size...
         if len(set((im.width, im.height) for im in self.textures)) != 1:
             raise TypeError("Invalid texture sizes")
@@ -131,6 +141,40 @@ class RenderTarget(object):
         glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
 
 
+class FrameSnapshot(object):
+    """
+    A copy of the last lit frame, so that it can be shown behind the menus while the game is paused without
+    running the geometry, shadow and light passes every frame
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.target = RenderTarget(size.x, size.y, size)
+        self.valid = False
+
+    def take(self):
+        """Copy what's on the screen right now. Call after the light pass but before the ui is drawn"""
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, 0)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.target.fbo)
+        glBlitFramebuffer(
+            0, 0, self.size.x, self.size.y, 0, 0, self.size.x, self.size.y, GL_COLOR_BUFFER_BIT, GL_NEAREST
+        )
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, 0)
+        self.valid = True
+
+    def invalidate(self):
+        self.valid = False
+
+    def draw(self):
+        """Start a frame with the snapshot covering the whole screen"""
+        opengl.clear_screen()
+        opengl.default_shader.use()
+        glDisable(GL_BLEND)
+        globals.screen.full_quad.set_texture_coordinates(constants.full_tc)
+        opengl.draw_all_now(globals.screen_quadbuffer, self.target, opengl.default_shader)
+        glEnable(GL_BLEND)
+
+
 # texture atlas code taken from
 # http://omnisaurusgames.com/2011/06/texture-atlas-generation-using-python/
 # I'm assuming it's open source!
@@ -149,31 +193,60 @@ class SubImage(object):
         )
 
 
+def cached_images(cached):
+    """The (pixels, size) pairs for each image in an atlas cache"""
+    return [(pixels, (cached.width, cached.height)) for pixels in cached.images]
+
+
 class TextureAtlas(object):
+    # The glyph tables cover all of latin-1, so text can be looked up directly by code point
+    glyph_table_size = 256
+
     def __init__(self, image_filename, data_filename, extra_names=True):
-        if extra_names:
-            extra_names = ("_normal", "_occlude", "_displace")
-            extra_names = [image_filename[:-4] + extra + image_filename[-4:] for extra in extra_names]
+        filenames = atlas_cache.group_filenames(image_filename, extra_names)
+        # If there's an up to date precompiled cache we can skip decoding the pngs and reading the metadata
+        cached = globals.assets.get(atlas_cache.cache_filename(image_filename))
+        if cached:
+            self.texture = Texture(*filenames, images=cached_images(cached))
+            lines = cached.metadata
         else:
-            extra_names = []
-
-        self.texture = Texture(image_filename, *extra_names)
+            self.texture = Texture(*filenames, images=[globals.assets.get(name) for name in filenames])
+            lines = globals.assets.get(data_filename)
         self.subimages = {}
-        data_filename = os.path.join(globals.dirs.resource, data_filename)
-        with open(data_filename, "r") as f:
-            for line in f:
-                subimage_name, image_name, x, y, w, h = line.strip().split(":")
-                # print image_name,image_filename
-                # assert(image_name) == image_filename
-                w = int(w)
-                h = int(h)
-                if subimage_name.startswith("font_"):
-                    subimage_name = chr(int(subimage_name[5:7], 16))
-                    h -= 4
-                subimage_name = "_".join(subimage_name.split("/"))
-                self.subimages[subimage_name] = SubImage(
-                    Point(float(x) / self.texture.width, float(y) / self.texture.height), (Point(w, h))
-                )
+        for line in lines:
+            subimage_name, image_name, x, y, w, h = line.strip().split(":")
+            # print image_name,image_filename
+            # assert(image_name) == image_filename
+            w = int(w)
+            h = int(h)
+            if subimage_name.startswith("font_"):
+                subimage_name = chr(int(subimage_name[5:7], 16))
+                h -= 4
+            subimage_name = "_".join(subimage_name.split("/"))
+            self.subimages[subimage_name] = SubImage(
+                Point(float(x) / self.texture.width, float(y) / self.texture.height), (Point(w, h))
+            )
+        self.build_glyph_table()
+
+    def build_glyph_table(self):
+        """
+        Precompute the texture coordinates and size of every single character subimage into contiguous
+        arrays indexed by code point. Laying out text is then just a gather over the encoded string rather
+        than a dict lookup and coordinate transform per letter
+        """
+        self.glyph_tc = numpy.zeros((self.glyph_table_size, 4, 2), numpy.float32)
+        self.glyph_size = numpy.zeros((self.glyph_table_size, 2), numpy.float32)
+        for name, subimage in self.subimages.items():
+            if len(name) != 1 or ord(name) >= self.glyph_table_size:
+                continue
+            code = ord(name)
+            scale = (float(subimage.size.x) / self.texture.width, float(subimage.size.y) / self.texture.height)
+            self.glyph_tc[code] = constants.full_tc * scale + (subimage.pos.x, subimage.pos.y)
+            self.glyph_size[code] = (subimage.size.x, subimage.size.y)
+
+    def encode(self, text):
+        """Turn a string into an array of code points suitable for indexing the glyph tables"""
+        return numpy.frombuffer(text.encode("latin-1"), numpy.uint8)
 
     def subimage(self, name):
         name = "_".join(name.split("/"))
@@ -201,7 +274,12 @@ class PetsciiAtlas(TextureAtlas):
     """
 
     def __init__(self, image_filename):
-        self.texture = Texture(image_filename)
+        cached = globals.assets.get(atlas_cache.cache_filename(image_filename))
+        if cached:
+            images = cached_images(cached)
+        else:
+            images = [globals.assets.get(image_filename)]
+        self.texture = Texture(image_filename, images=images)
         self.subimages = {}
         image_name = os.path.basename(image_filename)
         for ch in range(0x20, 0xA0):
@@ -219,6 +297,7 @@ class PetsciiAtlas(TextureAtlas):
             self.subimages[subimage_name] = SubImage(
                 Point(float(x) / self.texture.width, float(y) / self.texture.height), (Point(w, h))
             )
+        self.build_glyph_table()
 
 
 class TextTypes:
@@ -258,19 +337,39 @@ class TextManager(object):
     def letter(self, char, textType, userBuffer=None):
         """Given a character, return a quad with the corresponding letter on it in this textManager's font"""
         quad = quads.Quad(userBuffer if textType == TextTypes.CUSTOM else TextTypes.BUFFER[textType])
-        quad.tc[0:4] = self.atlas.texture_coords(char)
+        code = ord(char)
+        quad.tc[0:4] = self.atlas.glyph_tc[code]
         # this is a bit dodge, should get its own class if I want to store extra things in it
-        quad.width, quad.height = self.atlas.subimage(char).size
+        quad.width, quad.height = self.atlas.glyph_size[code].tolist()
         quad.letter = char
         return quad
 
+    def letters(self, text, textType, userBuffer=None):
+        """
+        Return a quad for each character in the text. The texture coordinates for the whole string are
+        gathered from the glyph table and written into the buffer in one go
+        """
+        buffer = userBuffer if textType == TextTypes.CUSTOM else TextTypes.BUFFER[textType]
+        codes = self.atlas.encode(text)
+        out = [quads.Quad(buffer) for char in text]
+        if not out:
+            return out
+
+        indices = numpy.array([quad.index for quad in out], numpy.uint32)
+        buffer.tc_data[indices[:, None] + numpy.arange(4)] = self.atlas.glyph_tc[codes]
+        for quad, char, (width, height) in zip(out, text, self.atlas.glyph_size[codes].tolist()):
+            quad.width = width
+            quad.height = height
+            quad.letter = char
+        return out
+
     def get_size(self, text, scale):
         """
         How big would the text be if drawn on a single row in the given size?
         """
-        sizes = [self.atlas.subimage(char).size * scale * global_scale for char in text]
-        out = Point(sum(item.x for item in sizes), max(item.y for item in sizes))
-        return out
+        sizes = self.atlas.glyph_size[self.atlas.encode(text)]
+        scale = scale * global_scale
+        return Point(float(sizes[:, 0].sum()) * scale, float(sizes[:, 1].max()) * scale)
 
     def draw(self):
         glLoadIdentity()
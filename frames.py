@@ -0,0 +1,230 @@
+"""
+Frame pacing. The FrameScheduler caps the frame rate and keeps a smoothed measure of how long frames are really
+taking, which is what the physics step size is worked out from. The QualityGovernor watches that against the
+frame budget and turns the expensive bits of the light pass down when we're over it, and back up again when
+there's room.
+"""
+import bisect
+import csv
+import os
+import time
+import pygame
+import drawing
+import globals
+
+
+class FrameTimeHistogram(object):
+    """Counts of frame times in ms, bucketed by the upper edges below"""
+
+    edges = [4, 8, 12, 16.7, 20, 25, 33.4, 50, 100]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.edges) + 1)
+        self.total = 0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(self.edges, ms)] += 1
+        self.total += 1
+
+    def percentile(self, fraction):
+        """The upper edge of the bucket that the given fraction of frames were quicker than"""
+        target = self.total * fraction
+        running = 0
+        for edge, count in zip(self.edges + [float("inf")], self.counts):
+            running += count
+            if running >= target:
+                return edge
+        return float("inf")
+
+    def report(self):
+        if not self.total:
+            return
+        print("Frame times:")
+        low = 0
+        for edge, count in zip(self.edges + [float("inf")], self.counts):
+            print(f"  {low:>5}-{edge:<5}ms: {count:>6} {100 * count / self.total:5.1f}%")
+            low = edge
+        print(f"  95% of frames under {self.percentile(0.95)}ms")
+
+
+class QualityGovernor(object):
+    """
+    Steps through quality levels of (shadow samples, max cone lights) according to how the smoothed frame time
+    compares with the budget. It needs to be over or under for a while before it changes, so it doesn't flap
+    """
+
+    levels = [
+        (512, None),
+        (384, None),
+        (256, 8),
+        (128, 4),
+    ]
+    over_frames = 30
+    under_frames = 120
+    headroom = 0.7
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.level = 0
+        self.over = 0
+        self.under = 0
+        self.apply()
+
+    def update(self, frame_time, budget):
+        if not self.enabled or budget is None:
+            return
+        if frame_time > budget:
+            self.over += 1
+            self.under = 0
+        elif frame_time < budget * self.headroom:
+            self.under += 1
+            self.over = 0
+        else:
+            self.over = self.under = 0
+
+        if self.over >= self.over_frames and self.level + 1 < len(self.levels):
+            self.level += 1
+            self.over = 0
+            self.apply()
+        elif self.under >= self.under_frames and self.level > 0:
+            self.level -= 1
+            self.under = 0
+            self.apply()
+
+    def apply(self):
+        shadow_samples, max_cone_lights = self.levels[self.level]
+        drawing.opengl.set_quality(shadow_samples, max_cone_lights)
+
+
+class FrameScheduler(object):
+    """
+    Caps the frame rate at the target (0 for uncapped) and measures the frame times. With vsync on the cap is
+    left to the display
+    """
+
+    smoothing = 0.1
+    # Don't let the physics step get so big that things tunnel through each other after a hitch
+    max_frame_time = 1.0 / 20
+
+    def __init__(self, target_fps, vsync=False, governor=None):
+        self.target_fps = target_fps
+        self.vsync = vsync
+        self.governor = governor
+        self.clock = pygame.time.Clock()
+        self.histogram = FrameTimeHistogram()
+        self.frame_time = 1.0 / target_fps if target_fps else 1.0 / 60
+        self.frame_start = time.perf_counter()
+        # How long the last frame took up to the flip, which is what the governor goes by
+        self.work_time = None
+        # Whether this frame is going at the target rate and so counts towards the measurements
+        self.measuring = True
+
+    @property
+    def budget(self):
+        """The time in seconds we have for each frame, or None if we're uncapped"""
+        return 1.0 / self.target_fps if self.target_fps else None
+
+    def tick(self, fps=None):
+        """
+        Wait until it's time for the next frame. fps overrides the target for this frame, and frames like that (the
+        paused ones) are left out of the frame time, the histogram and the governor, since they aren't the frames
+        the physics and the quality settings are for
+        """
+        self.measuring = fps is None
+        if fps is None:
+            fps = self.target_fps
+        if self.vsync or not fps:
+            ms = self.clock.tick()
+        else:
+            ms = self.clock.tick(fps)
+
+        if self.measuring:
+            self.histogram.add(ms)
+            # The first frame after startup or a pause can be huge, and the scheduler shouldn't take that as normal
+            seconds = min(ms / 1000.0, self.max_frame_time)
+            self.frame_time += (seconds - self.frame_time) * self.smoothing
+        if self.governor and self.work_time is not None:
+            self.governor.update(self.work_time, self.budget)
+        self.work_time = None
+        self.frame_start = time.perf_counter()
+        return ms
+
+    def flipping(self):
+        """
+        Call just before the flip. Neither the cap's sleep nor waiting for vblank in the flip are work we could cut
+        down on, so the governor only sees the time up to here. With vsync on we wait for the GPU first, which is
+        free since the flip would wait anyway, so that its work is counted too
+        """
+        if not self.measuring:
+            return
+        if self.vsync:
+            drawing.opengl.glFinish()
+        self.work_time = time.perf_counter() - self.frame_start
+
+
+def resident_kb():
+    """How much memory we're using right now, where we can find out"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+class FrameRecorder(object):
+    """
+    Writes a line of CSV for each frame with its time and how many of the things that could leak there are, so a
+    long run can show up memory leaks and frames getting slower
+    """
+
+    columns = [
+        "frame",
+        "time_ms",
+        "frame_ms",
+        "bodies",
+        "shapes",
+        "constraints",
+        "quads",
+        "cone_lights",
+        "shadow_rows",
+        "updated",
+        "skipped",
+        "score",
+        "rss_kb",
+    ]
+    # Memory use doesn't change quickly, and reading it isn't free
+    rss_every = 60
+
+    def __init__(self, filename):
+        self.file = open(filename, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.columns)
+        self.frame = 0
+        self.rss = 0
+
+    def record(self, t, ms, view):
+        space = globals.space
+        quads = globals.quad_buffer
+        if self.frame % self.rss_every == 0:
+            self.rss = resident_kb()
+        self.writer.writerow(
+            [
+                self.frame,
+                t,
+                ms,
+                len(space.bodies),
+                len(space.shapes),
+                len(space.constraints),
+                quads.current_size // quads.num_points - len(quads.vacant),
+                len(globals.cone_lights),
+                globals.shadow_quadbuffer.active_rows,
+                view.updates.updated,
+                view.updates.skipped,
+                view.score,
+                self.rss,
+            ]
+        )
+        self.frame += 1
+
+    def close(self):
+        self.file.close()
@@ -11,6 +11,7 @@ import random
 import enum
 import itertools
 import os
+import numpy
 from dataclasses import dataclass
 
 box_level = 7
@@ -41,6 +42,165 @@ def from_phys_coords(p):
     return p * phys_scale
 
 
+def shape_vertices(shape):
+    """The vertices of a poly shape relative to its body as an (n, 2) array"""
+    return numpy.array([tuple(v) for v in shape.get_vertices()], numpy.float64)
+
+
+def world_vertices(vertices, position, angle):
+    """
+    Rotate vertices by angle and then move them to position, in physics coordinates. This works on a single body's
+    (n, 2) vertices with a position and an angle, or on a batch of (m, n, 2) with (m, 2) positions and m angles
+    """
+    cos = numpy.cos(angle)[..., None]
+    sin = numpy.sin(angle)[..., None]
+    x = vertices[..., 0] * cos - vertices[..., 1] * sin + position[..., None, 0]
+    y = vertices[..., 0] * sin + vertices[..., 1] * cos + position[..., None, 1]
+    return numpy.stack((x, y), axis=-1)
+
+
+class BodySync(object):
+    """
+    Moves the quads of all the dynamic bodies to match the physics once a frame. Rather than each object rotating
+    its own vertices one at a time, the positions and angles of all the bodies are gathered up and the quads are
+    all transformed and written back in one go, so lots of packages don't cost much more than one. Bodies that
+    are asleep or haven't moved since they were last written are left alone
+    """
+
+    # The quad vertex each shape vertex goes to. The shapes go round the other way from the quads
+    quad_order = [(4 - i) & 3 for i in range(4)]
+    # How far a body has to move (in physics units) or turn (in radians) before its quad is rewritten
+    epsilon = 1e-3
+
+    def __init__(self):
+        self.items = []
+        self.vertices = None
+        self.z = None
+        self.last_position = None
+        self.last_angle = None
+
+    def add(self, item, z):
+        """item needs a body, a shape with 4 vertices and a quad in globals.quad_buffer"""
+        item.sync_z = z
+        self.items.append(item)
+        self.vertices = None
+
+    def remove(self, item):
+        try:
+            self.items.remove(item)
+        except ValueError:
+            return
+        self.vertices = None
+
+    def sync(self):
+        """Returns an array of whether each of the items moved"""
+        if not self.items:
+            return numpy.zeros(0, bool)
+        if self.vertices is None:
+            # The shapes don't change shape, so we can hang onto their vertices until something comes or goes
+            self.vertices = numpy.array([item.local_vertices[self.quad_order] for item in self.items])
+            self.z = numpy.array([item.sync_z for item in self.items], numpy.float32)
+            self.last_position = numpy.full((len(self.items), 2), numpy.nan)
+            self.last_angle = numpy.full(len(self.items), numpy.nan)
+
+        position = numpy.array([tuple(item.body.position) for item in self.items], numpy.float64)
+        angle = numpy.array([item.body.angle for item in self.items], numpy.float64)
+        sleeping = numpy.array([item.body.is_sleeping for item in self.items], bool)
+
+        # nan never compares as close, so new items always count as moved
+        moved = ~(
+            (numpy.abs(position - self.last_position) <= self.epsilon).all(axis=1)
+            & (numpy.abs(angle - self.last_angle) <= self.epsilon)
+        )
+        moved &= ~sleeping | numpy.isnan(self.last_angle)
+        if not moved.any():
+            return moved
+
+        self.last_position[moved] = position[moved]
+        self.last_angle[moved] = angle[moved]
+
+        vertices = numpy.empty((moved.sum(), 4, 3), numpy.float32)
+        vertices[:, :, :2] = world_vertices(self.vertices[moved], position[moved], angle[moved]) * phys_scale
+        vertices[:, :, 2] = self.z[moved, None]
+        quads = [item.quad for item, on in zip(self.items, moved) if on]
+        drawing.quads.set_quads_all_vertices(quads, vertices)
+        return moved
+
+
+class Mobility(enum.Enum):
+    STATIC = 0
+    KINEMATIC = 1
+    DYNAMIC = 2
+
+
+mobility_lookup = {
+    pymunk.Body.STATIC: Mobility.STATIC,
+    pymunk.Body.KINEMATIC: Mobility.KINEMATIC,
+    pymunk.Body.DYNAMIC: Mobility.DYNAMIC,
+}
+
+
+class UpdateScheduler(object):
+    """
+    Decides which objects need their update called each frame, by how they can move. Static things never do
+    after they're made, kinematic ones always do, and dynamic ones only when the physics has moved them, or when
+    their awake method says they have something else to do. The dynamic quads are synced here too
+    """
+
+    def __init__(self):
+        self.sync = BodySync()
+        self.kinematic = []
+        self.num_static = 0
+        # For the last frame
+        self.updated = 0
+        self.skipped = 0
+        self.frames = 0
+        self.total_updated = 0
+        self.total_skipped = 0
+
+    def add(self, item, z):
+        mobility = mobility_lookup[item.body.body_type]
+        if mobility == Mobility.STATIC:
+            self.num_static += 1
+        elif mobility == Mobility.KINEMATIC:
+            self.kinematic.append(item)
+        else:
+            self.sync.add(item, z)
+
+    def remove(self, item):
+        mobility = mobility_lookup[item.body.body_type]
+        if mobility == Mobility.STATIC:
+            self.num_static -= 1
+        elif mobility == Mobility.KINEMATIC:
+            self.kinematic.remove(item)
+        else:
+            self.sync.remove(item)
+
+    def update(self):
+        dynamic = self.sync.items
+        moved = self.sync.sync()
+        # Updates can add and remove things, so work out who's getting one first
+        run = [item for item, on in zip(dynamic, moved) if on or item.awake()]
+        run.extend(self.kinematic)
+
+        self.updated = len(run)
+        self.skipped = self.num_static + len(dynamic) + len(self.kinematic) - self.updated
+        self.frames += 1
+        self.total_updated += self.updated
+        self.total_skipped += self.skipped
+
+        for item in run:
+            item.update()
+
+    def report(self):
+        if not self.frames:
+            return
+        print(
+            f"Object updates per frame: {self.total_updated / self.frames:.2f} run, "
+            f"{self.total_skipped / self.frames:.2f} skipped"
+        )
+
+
 class CollisionTypes:
     DRONE = 1
     BOTTOM = 2
@@ -48,6 +208,84 @@ class CollisionTypes:
     WALL = 4
     RECEIVER = 5
     CHARGER = 6
+    MAILBOX = 7
+
+
+# What the moving things need to hit. Anything not in here (packages against mailboxes, or static things against
+# each other) is filtered out before the physics even looks at the pair
+collides_with = {
+    CollisionTypes.DRONE: {
+        CollisionTypes.BOTTOM,
+        CollisionTypes.BOX,
+        CollisionTypes.WALL,
+        CollisionTypes.RECEIVER,
+        CollisionTypes.CHARGER,
+        CollisionTypes.MAILBOX,
+    },
+    CollisionTypes.BOX: {
+        CollisionTypes.BOTTOM,
+        CollisionTypes.DRONE,
+        CollisionTypes.BOX,
+        CollisionTypes.WALL,
+        CollisionTypes.RECEIVER,
+        CollisionTypes.CHARGER,
+    },
+}
+
+
+def make_shape_filters():
+    masks = {}
+    for collision_type, others in collides_with.items():
+        for other in others:
+            masks[collision_type] = masks.get(collision_type, 0) | (1 << other)
+            masks[other] = masks.get(other, 0) | (1 << collision_type)
+    return {
+        collision_type: pymunk.ShapeFilter(categories=1 << collision_type, mask=mask)
+        for collision_type, mask in masks.items()
+    }
+
+
+shape_filters = make_shape_filters()
+
+
+class CollisionEvents(object):
+    """
+    The collision callbacks fire from inside space.step, for every contact on every substep, so they just note
+    what happened here and the game deals with it all once the frame's physics is done
+    """
+
+    JOSTLE = 0
+    RECEIVER_START = 1
+    RECEIVER_END = 2
+    CHARGER_START = 3
+    CHARGER_END = 4
+    BOTTOM_START = 5
+    BOTTOM_END = 6
+
+    drone_kinds = {BOTTOM_START, BOTTOM_END, CHARGER_START, CHARGER_END}
+
+    # Impacts with less kinetic energy than this don't hurt packages
+    min_jostle_ke = 150
+
+    def __init__(self):
+        # (kind, shapes, total kinetic energy) in the order they happened
+        self.events = []
+        self.add = self.events.append
+        self.frames = 0
+        self.total = 0
+
+    def take(self):
+        """Return the events so far and start again"""
+        events = self.events[:]
+        self.events.clear()
+        self.frames += 1
+        self.total += len(events)
+        return events
+
+    def report(self):
+        if not self.frames:
+            return
+        print(f"Collision events per frame: {self.total / self.frames:.2f}")
 
 
 class Directions(enum.IntFlag):
@@ -200,7 +438,7 @@ class Box(object):
     def __init__(self, parent, bl, tr, density_factor=1):
         self.parent = parent
         # bl, tr = (to_world_coords(x) for x in (bl, tr))
-        self.quad = drawing.Quad(globals.quad_buffer)
+        self.quad = drawing.Quad(self.quad_buffer())
         self.quad.set_vertices(bl, tr, box_level)
         self.normal_tc = parent.atlas.texture_coords(self.sprite_name)
 
@@ -226,21 +464,36 @@ class Box(object):
         self.shape.friction = 0.2
         self.shape.elasticity = 0.5
         self.shape.collision_type = self.collision_type
+        self.shape.filter = shape_filters[self.collision_type]
         self.shape.parent = self
+        self.local_vertices = shape_vertices(self.shape)
         globals.space.add(self.body, self.shape)
         self.in_world = True
+        parent.updates.add(self, box_level)
+
+    def quad_buffer(self):
+        # Static things never move, so they go in the buffer that stays on the GPU
+        if self.body_type == pymunk.Body.STATIC:
+            return globals.static_quad_buffer
+        return globals.quad_buffer
+
+    def awake(self):
+        """Whether we need an update even though the physics hasn't moved us"""
+        return False
 
     def update(self):
-        vertices = [0, 0, 0, 0]
-        for i, v in enumerate(self.shape.get_vertices()):
-            vertices[(4 - i) & 3] = from_phys_coords(v.rotated(self.body.angle) + self.body.position)
+        # Dynamic boxes get moved along with everything else by the parent's BodySync, this is for one-offs
+        vertices = self.world_vertices()[BodySync.quad_order] * phys_scale
+        self.quad.set_all_vertices([Point(*v) for v in vertices], box_level)
 
-        self.quad.set_all_vertices(vertices, box_level)
+    def world_vertices(self):
+        return world_vertices(self.local_vertices, numpy.array(self.body.position), self.body.angle)
 
     def delete(self):
         self.quad.delete()
         globals.space.remove(self.body, self.shape)
         self.in_world = False
+        self.parent.updates.remove(self)
 
 
 class Package(Box):
@@ -288,17 +541,13 @@ class Package(Box):
         return min(self.damage / self.max_damage, 1)
 
     def anchor_points(self):
-        orig_vertices = self.shape.get_vertices()
-        vertices = [0, 0, 0, 0]
-        for i, v in enumerate(orig_vertices):
-            vertices[i] = (i, v.rotated(self.body.angle) + self.body.position)
+        vertices = self.world_vertices()
 
         # We want the one that's most left and most up, and the one that's most right and most up
-        vertices.sort(key=lambda x: -x[1][1])
-        output = [orig_vertices[vertices[0][0]], orig_vertices[vertices[1][0]]]
-        output = [p * 0.8 for p in output]
+        order = numpy.argsort(-vertices[:, 1], kind="stable")
+        output = [pymunk.Vec2d(*self.local_vertices[i]) * 0.8 for i in order[:2]]
 
-        if vertices[0][1][0] < vertices[1][1][0]:
+        if vertices[order[0], 0] < vertices[order[1], 0]:
             self._anchor_points = output
         else:
             self._anchor_points = output[::-1]
@@ -319,6 +568,10 @@ class Package(Box):
         if self.on_receiver is None:
             self.on_receiver = globals.game_time
 
+    def awake(self):
+        # Sitting still on a receiver is how we get delivered
+        return self.last_update is None or self.on_receiver is not None
+
     def get_speed(self):
         # return self.body.velocity.length
 
@@ -329,7 +582,7 @@ class Package(Box):
             self.last_update = globals.game_time
             return
 
-        super().update()
+        # Our quad is moved by the parent's BodySync
 
         if self.on_receiver is not None:
             receive_time = globals.game_time - self.on_receiver
@@ -353,10 +606,11 @@ class Receiver(Box):
     is_package = False
     collision_type = CollisionTypes.RECEIVER
     body_type = pymunk.Body.STATIC
+    size = Point(40, 10)
 
     def __init__(self, parent, pos, id):
         bl = Point(pos, 0)
-        tr = bl + Point(40, 10)
+        tr = bl + self.size
 
         super().__init__(parent, bl, tr)
 
@@ -422,7 +676,7 @@ class House(Box):
         self.parent = parent
         density_factor = 1
         # bl, tr = (to_world_coords(x) for x in (bl, tr))
-        self.quad = drawing.Quad(globals.quad_buffer)
+        self.quad = drawing.Quad(self.quad_buffer())
         self.quad.set_vertices(bl, tr, house_level)
         self.normal_tc = parent.atlas.texture_coords(self.sprite_name)
         hack_fix_tc(self.normal_tc, hack_factor)
@@ -467,6 +721,7 @@ class House(Box):
             shape.friction = 0.2
             shape.elasticity = 0.5
             shape.collision_type = self.collision_type
+            shape.filter = shape_filters[self.collision_type]
             shape.parent = self
             globals.space.add(body, shape)
             self.bodies.append(body)
@@ -497,6 +752,7 @@ class House(Box):
 class Mailbox(House):
     sprite_template = "resource/sprites/mailbox_{num}{flag}.png"
     size = Point(32, 64)
+    collision_type = CollisionTypes.MAILBOX
     hack_factor = None
 
     parts = [
@@ -504,9 +760,11 @@ class Mailbox(House):
         (Point(0, 8), Point(15, 6), 0),
     ]
     light_data = []
+    # There are only this many numbered sprites, so infinite levels reuse them
+    sprite_count = 6
 
     def __init__(self, parent, box_num, pos, y=0):
-        self.sprite_name = self.sprite_template.format(num=box_num, flag="")
+        self.sprite_name = self.sprite_template.format(num=box_num % self.sprite_count, flag="")
         self.id = box_num
         super().__init__(parent, pos, y, hack_factor=None)
 
@@ -515,10 +773,17 @@ class Mailbox(House):
 
         # I can't seem to make it accept my hack factor. So hack the hack!
 
-        self.flag_tc = parent.atlas.texture_coords(self.sprite_template.format(num=box_num, flag=f"_flag"))
+        self.flag_tc = parent.atlas.texture_coords(
+            self.sprite_template.format(num=box_num % self.sprite_count, flag="_flag")
+        )
         self.current = self.normal_tc
         self.last_flag = globals.time
 
+    def reset(self):
+        # Put the flag down without any fuss
+        self.quad.set_texture_coordinates(self.normal_tc)
+        self.current = self.normal_tc
+
     def set_flag(self, flag):
 
         tc = self.flag_tc if flag else self.normal_tc
@@ -535,37 +800,35 @@ class Mailbox(House):
 
 
 class Ground(object):
+    """
+    The ground between left and right, which is usually one chunk of the world. The walls at the far ends of the
+    level are only added to the pieces that have them
+    """
+
     sprite_name = "resource/sprites/ground.png"
+    # Where the tiles started from back when the ground was one strip. Tiles are still laid out from here so they
+    # line up across chunks
+    origin = -300
+    ceiling = 1000
 
-    def __init__(self, parent, height):
+    def __init__(self, parent, height, left, right, left_wall=False, right_wall=False):
         self.parent = parent
         self.height = height
 
-        self.bottom_left = Point(-300, -self.height)
-        self.top_right = Point(128 * 100, 0)
+        self.bottom_left = Point(left, -self.height)
+        self.top_right = Point(right, 0)
         self.top_left = Point(self.bottom_left.x, 0)
         self.bottom_right = Point(self.top_right.x, self.bottom_left.y)
         self.size = self.top_right - self.bottom_left
 
-        self.ceiling_left = self.top_left + Point(0, 1000)
+        self.ceiling_left = self.top_left + Point(0, self.ceiling)
         self.ceiling_right = self.top_right + Point(0, self.ceiling_left.y)
 
         # Typically we'd do this with a single quad and adjust the texture coords for a repeat, but that gets
         # a bit more complicated with the lighting, so for speed lets just make a quad for each repeat, there won't be that many
         subimage = parent.atlas.subimage(self.sprite_name)
         tc = parent.atlas.texture_coords(self.sprite_name)
-
-        pos = Point(*self.bottom_left)
-        self.quads = []
-
-        quad_size = Point(subimage.size.x, self.height)
-
-        while pos.x < self.top_right.x:
-            quad = drawing.Quad(globals.quad_buffer, tc=tc)
-            quad.set_vertices(pos, pos + quad_size, ground_level)
-            self.quads.append(quad)
-
-            pos.x += subimage.size.x - 1
+        self.quads = tile_quads(tc, subimage.size.x - 1, left, right, Point(subimage.size.x, self.height), -height)
 
         # The ground is a simple static horizontal line (for now)
 
@@ -577,18 +840,22 @@ class Ground(object):
         )
         # bottom.sensor = True
         self.segment.collision_type = CollisionTypes.BOTTOM
+        self.segment.filter = shape_filters[CollisionTypes.BOTTOM]
         self.segment.friction = 1
         self.segment.parent = self
         self.elasticity = 0.3
+        self.join(self.segment, self.top_left, self.top_right)
 
         globals.space.add(self.segment)
         self.segments = [self.segment]
 
-        for (start, end) in (
-            (self.bottom_left + Point(300, 0), self.ceiling_left),
-            (self.ceiling_left, self.ceiling_right),
-            (self.ceiling_right, self.bottom_right),
-        ):
+        walls = [(self.ceiling_left, self.ceiling_right)]
+        if left_wall:
+            walls.append((self.bottom_left + Point(-self.origin, 0), self.ceiling_left))
+        if right_wall:
+            walls.append((self.ceiling_right, self.bottom_right))
+
+        for (start, end) in walls:
             # We'll also add a wall to the left
             segment = Segment(
                 globals.space.static_body,
@@ -598,26 +865,39 @@ class Ground(object):
             )
 
             segment.collision_type = CollisionTypes.WALL
+            segment.filter = shape_filters[CollisionTypes.WALL]
             segment.friction = 1
             segment.elasticity = 0.5
             segment.parent = self
+            if start.y == end.y:
+                self.join(segment, start, end)
             globals.space.add(segment)
             self.segments.append(segment)
 
+    def join(self, segment, left, right):
+        """
+        Tell the physics the line carries straight on past both ends, as it does in the chunks either side, so
+        nothing catches on the seams between chunks
+        """
+        width = Point(self.size.x, 0)
+        segment.set_neighbors(tuple(to_phys_coords(left - width)), tuple(to_phys_coords(right + width)))
+
     def delete(self):
         for segment in self.segments:
             globals.space.remove(segment)
+        for quad in self.quads:
+            quad.delete()
 
 
 class Sky(object):
     sprite_name = "resource/sprites/sky.png"
 
-    def __init__(self, parent):
+    def __init__(self, parent, left, right):
         self.parent = parent
 
-        self.bottom_left = Point(-300, 0)
-        self.top_right = Point(128 * 100, 1000)
-        self.top_left = Point(self.bottom_left.x, 1000)
+        self.bottom_left = Point(left, 0)
+        self.top_right = Point(right, Ground.ceiling)
+        self.top_left = Point(self.bottom_left.x, Ground.ceiling)
         self.bottom_right = Point(self.top_right.x, self.bottom_left.y)
         self.size = self.top_right - self.bottom_left
 
@@ -626,24 +906,181 @@ class Sky(object):
 
         subimage = parent.atlas.subimage(self.sprite_name)
         tc = parent.atlas.texture_coords(self.sprite_name)
+        self.quads = tile_quads(tc, subimage.size.x, left, right, Point(subimage.size.x, self.size.y), 0)
 
-        pos = Point(*self.bottom_left)
-        self.quads = []
+    def delete(self):
+        for quad in self.quads:
+            quad.delete()
+
+
+def tile_quads(tc, step, left, right, quad_size, y):
+    """
+    Make the static quads for the tiles starting between left and right, for tiles laid every step from
+    Ground.origin
+    """
+    first = max(math.ceil((left - Ground.origin) / step), 0)
+    pos = Point(Ground.origin + first * step, y)
+    quads = []
+    while pos.x < right:
+        quad = drawing.Quad(globals.static_quad_buffer, tc=tc)
+        quad.set_vertices(pos, pos + quad_size, ground_level)
+        quads.append(quad)
+        pos.x += step
+    return quads
+
+
+class WorldChunk(object):
+    """Everything static in one chunk of the level; ground, sky and the receivers, houses and so on"""
+
+    def __init__(self, streamer, index):
+        parent = streamer.parent
+        level = streamer.level
+        self.index = index
+        self.left = max(index * streamer.chunk_size, streamer.left)
+        self.right = (index + 1) * streamer.chunk_size
+        if streamer.right is not None:
+            self.right = min(self.right, streamer.right)
+
+        self.ground = Ground(
+            parent,
+            level.ground_height,
+            self.left,
+            self.right,
+            left_wall=self.left == streamer.left,
+            right_wall=self.right == streamer.right,
+        )
+        self.sky = Sky(parent, self.left, self.right)
+        self.receivers = []
+        self.houses = []
+        self.mailboxes = []
+        self.fences = []
+        self.chargers = []
+        if not streamer.contents:
+            return
 
-        quad_size = Point(subimage.size.x, self.size.y)
+        # Things belong to the chunk their position is in, and their ids come from the level so they're the same
+        # whenever the chunk is made
+        for i, pos in level.receivers_between(self.left, self.right):
+            self.receivers.append(Receiver(parent, pos, id=i))
+        for i, pos in level.receivers_between(self.left - 50, self.right - 50):
+            self.houses.append(House(parent, pos + 50, 0))
+        for i, pos in level.receivers_between(self.left + 50, self.right + 50):
+            mailbox = Mailbox(parent, i, pos - 50, 0)
+            self.houses.append(mailbox)
+            self.mailboxes.append(mailbox)
 
-        while pos.x < self.top_right.x:
-            quad = drawing.Quad(globals.quad_buffer, tc=tc)
-            quad.set_vertices(pos, pos + quad_size, ground_level)
-            self.quads.append(quad)
+        # Hack, put some fences up the left side
+        if self.left <= -80 < self.right:
+            for y in range(0, Ground.ceiling, Fence.size.y):
+                self.fences.append(Fence(parent, -80, y))
 
-            pos.x += subimage.size.x
+        for pos in level.fences:
+            if self.left <= pos < self.right:
+                self.fences.append(Fence(parent, pos))
 
-        # The ground is a simple static horizontal line (for now)
+        for pos in level.chargers:
+            if self.left <= pos < self.right:
+                self.chargers.append(Charger(parent, pos, id=0))
+
+    def delete(self):
+        for item in itertools.chain(self.receivers, self.houses, self.fences, self.chargers):
+            item.delete()
+        self.ground.delete()
+        self.sky.delete()
+
+
+class WorldStreamer(object):
+    """
+    Splits a level into chunks along x, and keeps only the ones near the drone and the packages in the world. The
+    rest don't have any quads or physics shapes. Infinite levels have no right hand end
+    """
+
+    chunk_size = 1024
+    # How many chunks either side of something interesting to keep loaded
+    load_distance = 2
+    # Where the world ends for levels that aren't infinite
+    level_right = 128 * 100
+
+    def __init__(self, parent, level, contents=True):
+        self.parent = parent
+        self.level = level
+        self.contents = contents
+        self.left = Ground.origin
+        self.right = None if level.infinite else self.level_right
+        self.chunks = {}
+        self.mailbox_lookup = {}
+        self.max_receiver_id = -1
+
+    def chunk_index(self, x):
+        return math.floor(x / self.chunk_size)
+
+    def update(self, focus):
+        """
+        Load the chunks near any of the x positions in focus and tear down the ones that aren't any more. Returns
+        whether anything changed
+        """
+        first = self.chunk_index(self.left)
+        last = None if self.right is None else self.chunk_index(self.right - 1)
+        wanted = set()
+        for x in focus:
+            centre = self.chunk_index(x)
+            for index in range(centre - self.load_distance, centre + self.load_distance + 1):
+                if index >= first and (last is None or index <= last):
+                    wanted.add(index)
+
+        if wanted == self.chunks.keys():
+            return False
+
+        for index in list(self.chunks.keys()):
+            if index not in wanted:
+                self.unload(index)
+        for index in sorted(wanted):
+            if index not in self.chunks:
+                self.load(index)
+        return True
+
+    def load(self, index):
+        chunk = self.chunks[index] = WorldChunk(self, index)
+        for mailbox in chunk.mailboxes:
+            self.mailbox_lookup[mailbox.id] = mailbox
+        for receiver in chunk.receivers:
+            self.max_receiver_id = max(self.max_receiver_id, receiver.id)
+
+    def unload(self, index):
+        chunk = self.chunks.pop(index)
+        for mailbox in chunk.mailboxes:
+            del self.mailbox_lookup[mailbox.id]
+        chunk.delete()
+
+    def delete(self):
+        for index in list(self.chunks.keys()):
+            self.unload(index)
+
+    def restart(self):
+        """Go back to how things were when the level started, keeping any chunks that are still wanted"""
+        self.update([self.level.start_pos.x])
+        for mailbox in self.mailbox_lookup.values():
+            mailbox.reset()
+        self.max_receiver_id = max((receiver.id for receiver in self.receivers()), default=-1)
+
+    def extent(self):
+        """The left and right of the part of the world that's loaded"""
+        chunks = self.chunks.values()
+        return min(chunk.left for chunk in chunks), max(chunk.right for chunk in chunks)
+
+    def receivers(self):
+        return [receiver for chunk in self.chunks.values() for receiver in chunk.receivers]
+
+    def random_target(self):
+        """Pick a receiver id for a package. Infinite levels pick from the ones that have been seen so far"""
+        if self.level.infinite:
+            return random.randint(0, max(self.max_receiver_id, 0))
+        return random.randint(0, len(self.level.receivers) - 1)
 
 
 class Light(object):
     z = 80
+    static_shadow = False
 
     def __init__(self, pos, radius=400, intensity=1):
         self.radius = radius
@@ -738,6 +1175,7 @@ class ConeLight(object):
     width = 700
     height = 700
     z = 60
+    static_shadow = False
 
     def __init__(self, parent, pos, angle, width, colour):
         self.parent = parent
@@ -783,6 +1221,7 @@ class ConeLight(object):
 
     def delete(self):
         self.quad.delete()
+        self.shadow_quad.delete()
         globals.cone_lights = [light for light in globals.cone_lights if light is not self]
 
 
@@ -791,12 +1230,16 @@ class FixedConeLight:
     width = 700
     height = 700
     z = 60
+    # We don't move, so our shadow row only needs drawing again when the ShadowCache says so
+    static_shadow = True
 
     def __init__(self, pos, angle, width, colour):
         self.quad_buffer = drawing.QuadBuffer(4)
         self.quad = drawing.Quad(self.quad_buffer)
         self.shadow_quad = globals.shadow_quadbuffer.new_light()
         self.shadow_index = self.shadow_quad.shadow_index
+        self.shadow_valid = False
+        self.dynamic_nearby = False
         self.colour = colour
         self.initial_angle = angle
         self.angle = angle
@@ -830,9 +1273,75 @@ class FixedConeLight:
 
     def delete(self):
         self.quad.delete()
+        self.shadow_quad.delete()
         globals.cone_lights = [light for light in globals.cone_lights if light is not self]
 
 
+class ShadowCache(object):
+    """
+    Decides which of the static lights need their shadow rows drawn again this frame. The rows are worked out in
+    screen space, so they all go stale when the view moves by a pixel or more. Otherwise a light's row is only
+    redrawn when something that moves is within reach of it (or just was, so its shadow gets cleared away), the
+    static scenery has changed, or the quality governor has changed the shadow quality
+    """
+
+    # How far the shadow shader looks from a light, in screen pixels
+    shadow_reach = 384
+
+    def __init__(self):
+        self.view_pos = None
+        self.generation = None
+        self.redrawn = 0
+        self.frames = 0
+
+    def update(self, view):
+        lights = [light for light in globals.cone_lights if light.static_shadow]
+        if not lights:
+            return
+
+        view_pos = view.viewpos.pos * globals.scale
+        everything = (
+            self.view_pos is None
+            or abs(view_pos.x - self.view_pos.x) >= 1
+            or abs(view_pos.y - self.view_pos.y) >= 1
+            or self.generation != drawing.opengl.shadow_generation
+            or globals.static_quad_buffer.dirty
+        )
+        self.view_pos = view_pos
+        self.generation = drawing.opengl.shadow_generation
+
+        nearby = self.dynamic_nearby(view, lights)
+        for light, near in zip(lights, nearby):
+            if everything or near or light.dynamic_nearby:
+                light.shadow_valid = False
+            light.dynamic_nearby = near
+            if not light.shadow_valid:
+                self.redrawn += 1
+        self.frames += 1
+
+    def dynamic_nearby(self, view, lights):
+        """Whether each light has the bounding box of a moving body within its reach"""
+        items = view.updates.sync.items
+        if not items:
+            return numpy.zeros(len(lights), bool)
+        reach = self.shadow_reach / globals.scale.x
+        centres = numpy.array([tuple(light.pos[:2]) for light in lights], numpy.float64)
+        boxes = numpy.array(
+            [(bb.left, bb.bottom, bb.right, bb.top) for bb in (item.shape.bb for item in items)], numpy.float64
+        )
+        boxes *= phys_scale
+        # The closest point of each box to each light
+        closest_x = numpy.clip(centres[:, None, 0], boxes[None, :, 0], boxes[None, :, 2])
+        closest_y = numpy.clip(centres[:, None, 1], boxes[None, :, 1], boxes[None, :, 3])
+        distance = numpy.hypot(closest_x - centres[:, None, 0], closest_y - centres[:, None, 1])
+        return (distance < reach).any(axis=1)
+
+    def report(self):
+        if not self.frames:
+            return
+        print(f"Static shadow rows redrawn per frame: {self.redrawn / self.frames:.2f}")
+
+
 def hack_fix_tc(tc, hack_factor):
     x_low = min(vertex[0] for vertex in tc)
     x_high = max(vertex[0] for vertex in tc)
@@ -930,6 +1439,7 @@ class Drone(object):
     max_squirters = 100
     squirt_range = 0.6
     sound_thresh = 100
+    mass = 0.08
 
     def __init__(self, parent, pos):
         self.parent = parent
@@ -940,18 +1450,9 @@ class Drone(object):
         # pos = to_world_coords(pos)
         self.bottom_left = pos
         self.top_right = pos + self.size
-        self.turning_enabled = True
-        self.grabbed = None
-        self.power = 100
-        self.on_ground = None
-        self.on_charger = None
-        self.start_power = 0
-        self.thrust = self.max_desired
         self.quad.set_texture_coordinates(self.tcs[0])
         self.left_squirters = []
         self.right_squirters = []
-        self.last_squirt = [0, 0]
-        self.squirt_delay = [0, 0]
         self.last_sound_change = 0
 
         self.quad.set_vertices(self.bottom_left, self.top_right, drone_level)
@@ -963,7 +1464,6 @@ class Drone(object):
         ]
         vertices = [tuple(to_phys_coords(Point(*v[:2]) - centre)) for v in self.quad.vertex[:4]]
 
-        self.mass = 0.08
         self.moment = pymunk.moment_for_poly(self.mass, vertices)
         self.body = Body(mass=self.mass, moment=self.moment)
         self.body.position = to_phys_coords(self.quad.get_centre().to_float())
@@ -976,10 +1476,12 @@ class Drone(object):
         self.shape.friction = 0.5
         self.shape.elasticity = 0.3
         self.shape.collision_type = CollisionTypes.DRONE
+        self.shape.filter = shape_filters[CollisionTypes.DRONE]
         self.shape.parent = self
+        self.local_vertices = shape_vertices(self.shape)
         globals.space.add(self.body, self.shape)
+        parent.updates.add(self, box_level)
         self.rotor_sound = None
-        self.charge_played = False
 
         # self.polar_vertices = [cmath.polar(v[0] + v[1] * 1j) for v in self.vertices]
 
@@ -993,20 +1495,57 @@ class Drone(object):
         # self.jet_lines = [Line(self, Point(0, 0), Point(300, 3000)) for i in (0, 1)]
         self.jet_lines = []
 
+        self.jets = self.shape.get_vertices()[:2]
+        self.anchors = []
+        self.joints = []
+        # Our anchor points are our bottom left and our bottom right
+
+        self.anchor_points = [jet * 0.9 for jet in self.jets]
+        self.reset_state()
+
+    def reset_state(self):
+        """Everything that goes back to how it was when the level starts again"""
+        self.turning_enabled = True
+        self.grabbed = None
+        self.power = 100
+        self.on_ground = None
+        # The ground segments we're touching. There can be two at once on a seam between chunks
+        self.ground_contacts = set()
+        self.on_charger = None
+        self.start_power = 0
+        self.thrust = self.max_desired
+        self.last_squirt = [0, 0]
+        self.squirt_delay = [0, 0]
+        self.charge_played = False
         self.desired_shift = Point(0, 0)
         self.desired_pos = from_phys_coords(self.body.position)
         self.desired_field = 0
         self.desired_vector = Point(0, 0)
         self.last_update = None
-        self.jets = self.shape.get_vertices()[:2]
         self.reset_forces()
         self.target_rotation = 0
         self.engine = True
         self.soft_off = False
+
+    def reset(self, state):
+        """Go back to the start of the level, reusing our body, quads and lights"""
+        for joint in self.joints:
+            globals.space.remove(joint)
+        for anchor in self.anchors:
+            anchor.delete()
         self.anchors = []
-        # Our anchor points are our bottom left and our bottom right
+        self.joints = []
+        for squirt in itertools.chain(self.left_squirters, self.right_squirters):
+            squirt.delete()
+        self.left_squirters = []
+        self.right_squirters = []
+        if self.charge_played:
+            globals.sounds.charging.stop()
 
-        self.anchor_points = [jet * 0.9 for jet in self.jets]
+        state.restore(self.body)
+        self.reset_state()
+        for light in self.lights:
+            light.on = True
 
     def disable_turning(self):
         self.turning_enabled = False
@@ -1130,10 +1669,6 @@ class Drone(object):
                 self.on_ground = None
                 self.soft_off = True
 
-        vertices = [0, 0, 0, 0]
-        for i, v in enumerate(self.shape.get_vertices()):
-            vertices[(4 - i) & 3] = from_phys_coords(v.rotated(self.body.angle) + self.body.position)
-
         if self.forces is not None:
             # Debug draw the lines
             # for force, jet, line in zip(self.forces, vertices[::3], self.jet_lines):
@@ -1151,8 +1686,6 @@ class Drone(object):
                 except ZeroDivisionError:
                     self.squirt_delay[i] = 200
 
-        self.quad.set_all_vertices(vertices, box_level)
-
         elapsed = (globals.game_time - self.last_update) * globals.time_step
         self.last_update = globals.game_time
 
@@ -1333,16 +1866,15 @@ class Drone(object):
     def flying(self):
         return self.desired_field != 0
 
-    def landed(self):
-        orig_vertices = self.shape.get_vertices()
-        vertices = [0, 0, 0, 0]
-        for i, v in enumerate(orig_vertices):
-            vertices[i] = v.rotated(self.body.angle) + self.body.position
+    def awake(self):
+        # The engine, squirts and sounds carry on whether we're moving or not
+        return True
 
-        # We want the one that's most left and most up, and the one that's most right and most up
-        vertices.sort(key=lambda x: x[1])
+    def landed(self):
+        vertices = world_vertices(self.local_vertices, numpy.array(self.body.position), self.body.angle)
 
-        return all(vertex[1] < 12 for vertex in vertices[:2])
+        # We want the two lowest ones
+        return bool((numpy.sort(vertices[:, 1])[:2] < 12).all())
 
     def key_down(self, key):
         try:
@@ -1379,12 +1911,363 @@ class Drone(object):
     def delete(self):
         for line in itertools.chain(self.jet_lines, self.anchors):
             line.delete()
+        for joint in self.joints:
+            globals.space.remove(joint)
         self.quad.delete()
         for squirt in itertools.chain(self.left_squirters, self.right_squirters):
             squirt.delete()
         for light in self.lights:
             light.delete()
         globals.space.remove(self.body, self.shape)
+        self.parent.updates.remove(self)
+
+
+class FleetDrone(object):
+    """
+    One of the fleet's drones. These have a body, a shape and a quad so the BodySync can move them like anything
+    else, but all the thinking is done by the Fleet
+    """
+
+    def __init__(self, parent, pos, size, vertices, tc):
+        self.parent = parent
+        self.quad = drawing.Quad(globals.quad_buffer, tc=tc)
+        self.body = Body(mass=Drone.mass, moment=pymunk.moment_for_poly(Drone.mass, vertices))
+        self.body.position = to_phys_coords(pos + size * 0.5)
+        self.shape = pymunk.Poly(self.body, vertices)
+        self.shape.friction = 0.5
+        self.shape.elasticity = 0.3
+        self.shape.collision_type = CollisionTypes.DRONE
+        self.shape.filter = shape_filters[CollisionTypes.DRONE]
+        self.shape.parent = self
+        self.local_vertices = shape_vertices(self.shape)
+        self.jets = self.shape.get_vertices()[:2]
+        self.anchor_points = [jet * 0.9 for jet in self.jets]
+        self.joints = []
+        self.box = None
+        globals.space.add(self.body, self.shape)
+        parent.updates.add(self, box_level)
+
+    def awake(self):
+        return False
+
+    def update(self):
+        pass
+
+    def grab(self, box):
+        self.box = box
+        for our_anchor, box_anchor in zip(self.anchor_points, box.anchor_points()):
+            joint = pymunk.SlideJoint(
+                self.body, box.body, anchor_a=our_anchor, anchor_b=box_anchor, min=0, max=Drone.grab_range
+            )
+            self.joints.append(joint)
+            globals.space.add(joint)
+
+    def release(self):
+        for joint in self.joints:
+            globals.space.remove(joint)
+        self.joints = []
+
+    def delete(self):
+        self.release()
+        if self.box:
+            self.box.delete()
+            self.box = None
+        self.quad.delete()
+        globals.space.remove(self.body, self.shape)
+        self.parent.updates.remove(self)
+
+
+class FleetBox(Box):
+    """A package for a fleet drone. It gets carried about and dropped, but it isn't anyone's delivery"""
+
+    size = Point(30, 30)
+    sprite_name = "resource/sprites/box_30_30.png"
+    anchor_points = Package.anchor_points
+
+    def __init__(self, parent, bl):
+        super().__init__(parent, bl, bl + self.size)
+
+    def update(self):
+        # The BodySync moves our quad, and there's nothing else to do
+        pass
+
+
+class Fleet(object):
+    """
+    A fleet of drones flying packages out to the receivers on their own, for stress testing and showing off. They
+    fly like the player's drone, but the controller state for all of them is kept in numpy arrays and their forces
+    are worked out for all of them at once on each physics step. They don't have lights or sounds, and they fly
+    through each other
+    """
+
+    columns = 20
+    spacing = Point(30, 60)
+    # How far above home each drone flies, so their packages don't all pile into each other
+    cruise_height = 100
+    # How close counts as being there
+    arrive_distance = 20
+    height_slack = 10
+    home_power = Drone.power_max
+
+    OUTBOUND = 0
+    RETURNING = 1
+
+    def __init__(self, parent, count, start):
+        self.parent = parent
+        self.size = size = parent.atlas.subimage(Drone.sprite_names[0]).size
+        self.tcs = [parent.atlas.texture_coords(sprite_name) for sprite_name in Drone.sprite_names]
+        centre = size * 0.5
+        vertices = [
+            tuple(to_phys_coords(v - centre)) for v in (Point(0, 0), Point(0, size.y), size, Point(size.x, 0))
+        ]
+
+        self.drones = []
+        home = []
+        for i in range(count):
+            row, column = divmod(i, self.columns)
+            pos = start + Point(column * self.spacing.x, row * self.spacing.y)
+            self.drones.append(FleetDrone(parent, pos, size, vertices, self.tcs[0]))
+            home.append(tuple(to_phys_coords(pos + centre)))
+
+        self.home = numpy.array(home, numpy.float64)
+        self.cruise = self.home[:, 1] + self.cruise_height
+        self.target = self.home.copy()
+        self.phase = numpy.full(count, self.RETURNING)
+        self.desired_shift = numpy.zeros((count, 2), numpy.float64)
+        self.thrust = numpy.full(count, Drone.max_desired, numpy.float64)
+        self.power = numpy.full(count, self.home_power, numpy.float64)
+        self.engine = numpy.ones(count, bool)
+        self.carrying = numpy.zeros(count, bool)
+        self.target_rotation = numpy.zeros(count, numpy.float64)
+        self.force = numpy.zeros((count, 2), numpy.float64)
+        self.last_update = None
+        self.quad_indices = drawing.quads.quad_vertex_indices([drone.quad for drone in self.drones])
+
+    def gather(self):
+        position = numpy.array([tuple(drone.body.position) for drone in self.drones], numpy.float64)
+        velocity = numpy.array([tuple(drone.body.velocity) for drone in self.drones], numpy.float64)
+        angle = numpy.array([drone.body.angle for drone in self.drones], numpy.float64)
+        return position, velocity, angle
+
+    def focus(self):
+        """x positions the world needs to be loaded around, so the packages have something to land on"""
+        return [from_phys_coords(drone.box.body.position.x) for drone in self.drones if drone.box]
+
+    def update(self):
+        """Once a frame, decide where everyone's going and steer towards it"""
+        if not self.drones:
+            return
+        if self.last_update is None:
+            self.last_update = globals.game_time
+            return
+        elapsed = globals.game_time - self.last_update
+        self.last_update = globals.game_time
+
+        position, velocity, angle = self.gather()
+        self.arrivals(position)
+
+        # Head for the target at cruising height, the same as holding down the keys would
+        offset = self.target - position
+        offset[:, 1] = self.cruise - position[:, 1]
+        vector = numpy.sign(offset)
+        vector[numpy.abs(offset[:, 0]) < self.arrive_distance, 0] = 0
+        vector[numpy.abs(offset[:, 1]) < self.height_slack, 1] = 0
+
+        # Without any input the desired shift decays away
+        idle = ~vector.any(axis=1)
+        length = numpy.hypot(*self.desired_shift.T)
+        vector[idle] = self.desired_shift[idle] * -0.2
+        self.desired_shift[idle & (length <= Drone.min_desired)] = 0
+
+        self.desired_shift += vector * Drone.desired_speed * (elapsed / 1000)
+        length = numpy.hypot(*self.desired_shift.T)
+        over = length > self.thrust
+        self.desired_shift[over] *= (self.thrust[over] / length[over])[:, None]
+
+        fuel = numpy.hypot(*self.force.T) * (elapsed / 1000)
+        self.power = numpy.clip(self.power - fuel * Drone.power_consumption, 0, self.home_power)
+        self.engine = self.power > 0
+
+        tc = self.tcs[int((globals.game_time // Drone.frame_delta) % len(self.tcs))]
+        globals.quad_buffer.tc_data[self.quad_indices] = tc
+        globals.quad_buffer.dirty = True
+
+    def arrivals(self, position):
+        there = numpy.abs(self.target[:, 0] - position[:, 0]) < self.arrive_distance
+        delivered = numpy.flatnonzero(there & (self.phase == self.OUTBOUND))
+        for i in delivered:
+            self.drones[i].release()
+            self.carrying[i] = False
+        self.phase[delivered] = self.RETURNING
+        self.target[delivered] = self.home[delivered]
+
+        receivers = self.parent.streamer.receivers()
+        home = numpy.flatnonzero(there & (self.phase == self.RETURNING))
+        if not receivers:
+            return
+        for i in home:
+            # Fill up, clear away the last package and take a new one out to somewhere nearby
+            drone = self.drones[i]
+            if drone.box:
+                drone.box.delete()
+            bl = from_phys_coords(Point(*drone.body.position))
+            bl -= Point(FleetBox.size.x * 0.5, self.size.y * 0.5 + FleetBox.size.y + 2)
+            drone.box = FleetBox(self.parent, bl)
+            drone.grab(drone.box)
+            receiver = random.choice(receivers)
+            self.target[i] = tuple(receiver.body.position)
+            self.carrying[i] = True
+            self.power[i] = self.home_power
+        self.phase[home] = self.OUTBOUND
+
+    def apply_forces(self):
+        """The same sums as Drone.calculate_forces and Drone.apply_forces, for everyone at once"""
+        if not self.drones:
+            return
+        position, velocity, angle = self.gather()
+        mass = Drone.mass
+        anti_grav = -globals.space.gravity[1] * mass * 0.5
+
+        desired = self.desired_shift - velocity * 0.1 / phys_scale
+        self.target_rotation = math.pi * 0.5 * (desired[:, 0] / Drone.max_desired)
+        grab_factor = numpy.where(self.carrying, 10, 5)
+        self.force[:, 0] = desired[:, 0]
+        self.force[:, 1] = anti_grav * 2 + desired[:, 1] * grab_factor
+        self.force[~self.engine] = 0
+
+        # The force is applied in the body's frame
+        cos = numpy.cos(-angle)
+        sin = numpy.sin(-angle)
+        local = numpy.stack(
+            (self.force[:, 0] * cos - self.force[:, 1] * sin, self.force[:, 0] * sin + self.force[:, 1] * cos),
+            axis=-1,
+        )
+
+        desired_angle = -0.5 * (math.pi * 0.5 * (self.desired_shift[:, 0] / Drone.max_desired))
+        angular_velocity = (desired_angle - angle) * globals.dt * 4000
+        angular_velocity[numpy.abs(angular_velocity) < 0.05] = 0
+
+        for drone, force, spin, on in zip(self.drones, local.tolist(), angular_velocity.tolist(), self.engine):
+            if on:
+                drone.body.apply_force_at_local_point(tuple(force), (0, 0))
+                drone.body.angular_velocity = spin
+
+    def delete(self):
+        for drone in self.drones:
+            drone.delete()
+        self.drones = []
+
+
+class Autopilot(object):
+    """
+    Flies the drone for benchmark and soak runs. It only uses what a player has, the direction keys and a click
+    under the drone to grab or let go, so it exercises the same code. It picks up the current package, takes it to
+    its receiver and drops it there, and goes to the charger when it's running low
+    """
+
+    keys = {
+        Directions.UP: pygame.locals.K_UP,
+        Directions.DOWN: pygame.locals.K_DOWN,
+        Directions.LEFT: pygame.locals.K_LEFT,
+        Directions.RIGHT: pygame.locals.K_RIGHT,
+    }
+    # How close to where we're going counts as there
+    slack = Point(4, 4)
+    cruise_height = 120
+    # Gap to leave between us and the top of a package when grabbing it
+    grab_gap = 6
+    # Drop the package once it's this close to the top of the receiver
+    drop_height = 4
+    low_power = 25
+    charged = 95
+
+    def __init__(self, view):
+        self.view = view
+        self.held = Directions(0)
+        self.charging = False
+
+    def press(self, wanted):
+        """Hold down the keys for the wanted directions and let go of the rest"""
+        drone = self.view.drone
+        for direction, key in self.keys.items():
+            if wanted & direction and not self.held & direction:
+                drone.key_down(key)
+            elif self.held & direction and not wanted & direction:
+                drone.key_up(key)
+        self.held = wanted
+
+    def steer(self, pos, target):
+        """Press towards target from pos, and return whether we're there"""
+        diff = target - pos
+        wanted = Directions(0)
+        if diff.x > self.slack.x:
+            wanted |= Directions.RIGHT
+        elif diff.x < -self.slack.x:
+            wanted |= Directions.LEFT
+        if diff.y > self.slack.y:
+            wanted |= Directions.UP
+        elif diff.y < -self.slack.y:
+            wanted |= Directions.DOWN
+        self.press(wanted)
+        return not wanted
+
+    def click(self, world_pos):
+        """Click at world_pos, which is how the player grabs and releases packages"""
+        mouse_world = globals.mouse_world
+        globals.mouse_world = world_pos
+        self.view.mouse_button_up(globals.mouse_screen, 1)
+        globals.mouse_world = mouse_world
+
+    def update(self):
+        view = self.view
+        drone = view.drone
+        if view.paused or drone is None or not view.packages:
+            if drone:
+                self.press(Directions(0))
+            return
+
+        package = view.packages[0]
+        level = view.levels[view.current_level]
+        pos = from_phys_coords(Point(*drone.body.position))
+        corners = package.world_vertices() * phys_scale
+        package_centre = Point(*corners.mean(axis=0))
+        package_top = corners[:, 1].max()
+        package_bottom = corners[:, 1].min()
+        half_height = drone.size.y * 0.5
+
+        if drone.grabbed:
+            target_x = level.receiver_pos(package.id) + 20
+            if abs(target_x - pos.x) > self.slack.x * 4:
+                self.steer(pos, Point(target_x, self.cruise_height))
+                return
+            # Over the receiver, so bring it down gently and let go just above it
+            drop_y = Receiver.size.y + self.drop_height
+            self.steer(pos, Point(target_x, pos.y - package_bottom + drop_y))
+            if abs(target_x - pos.x) <= self.slack.x and package_bottom < drop_y + self.drop_height:
+                self.click(package_centre)
+            return
+
+        if package.on_receiver is not None:
+            # Keep out of the way while it's delivered
+            self.steer(pos, Point(package_centre.x, self.cruise_height))
+            return
+
+        if drone.power < self.low_power:
+            self.charging = True
+        if self.charging:
+            charger = Point(level.chargers[0] + 20, 10 + half_height)
+            if drone.on_charger is not None and drone.power < self.charged:
+                self.press(Directions(0))
+            elif drone.power >= self.charged:
+                self.charging = False
+            else:
+                self.steer(pos, charger)
+            return
+
+        hover = Point(package_centre.x, package_top + half_height + self.grab_gap)
+        if self.steer(pos, hover):
+            # Just inside the top of the package, right under us
+            self.click(Point(package_centre.x, package_top - 2))
 
 
 class Line(object):
@@ -1596,6 +2479,13 @@ class Level(object):
         PackageInfo(contents="Feathers", size=Point(50, 50), target=3, max_speed=100, density=0.1, time=15),
     ]
 
+    def receivers_between(self, left, right):
+        """(id, x) for each receiver with left <= x < right"""
+        return [(i, pos) for i, pos in enumerate(self.receivers) if left <= pos < right]
+
+    def receiver_pos(self, id):
+        return self.receivers[id]
+
     def get_random_package(self):
         # let's have a 40 % chance of a pre-built
         index = random.randint(1, 12)
@@ -1687,6 +2577,51 @@ class LevelTwo(Level):
     min_distance = 200
     min_force = 50
 
+    def receivers_between(self, left, right):
+        # The street goes on forever, so work them out rather than keeping a list
+        first = max(math.ceil((left - 600) / 500), 0)
+        return [(i, self.receiver_pos(i)) for i in range(first, math.ceil((right - 600) / 500))]
+
+    def receiver_pos(self, id):
+        return 600 + id * 500
+
+
+@dataclass
+class BodyState:
+    position: tuple
+    angle: float
+    velocity: tuple
+    angular_velocity: float
+
+    @classmethod
+    def capture(cls, body):
+        return cls(tuple(body.position), body.angle, tuple(body.velocity), body.angular_velocity)
+
+    def restore(self, body):
+        body.position = self.position
+        body.angle = self.angle
+        body.velocity = self.velocity
+        body.angular_velocity = self.angular_velocity
+        body.force = 0, 0
+        body.torque = 0
+        globals.space.reindex_shapes_for_body(body)
+
+
+class LevelSnapshot(object):
+    """
+    How a level was just after it was built, so that starting it again can put things back rather than throwing it
+    all away and building it again. The world chunks are kept as they are, and the drone keeps its body, quads and
+    lights and just goes back to where it started
+    """
+
+    def __init__(self, level, drone):
+        self.level = level
+        self.drone = BodyState.capture(drone.body)
+
+    def restore(self, view):
+        view.streamer.restart()
+        view.drone.reset(self.drone)
+
 
 class TimeOfDay(object):
     night_light_dir = (1, 3, -5)
@@ -1856,6 +2791,8 @@ class Tutorial:
 
 class GameView(ui.RootElement):
     text_fade_duration = 1000
+    paused = False
+    cull_margin = 64
     next_package_format = "Number {number}"
 
     def __init__(self):
@@ -1874,12 +2811,16 @@ class GameView(ui.RootElement):
         self.game_time_diff = 0
         self.current_info = None
 
+        self.updates = UpdateScheduler()
+        self.shadow_cache = ShadowCache()
+
         # For the ambient light
         self.atlas = drawing.texture.TextureAtlas("atlas_0.png", "atlas.txt")
-        self.ground = Ground(self, TutorialLevel.ground_height)
-        self.sky = Sky(self)
+        # Just the scenery until a level is started
+        self.streamer = WorldStreamer(self, TutorialLevel, contents=False)
+        self.streamer.update([self.viewpos.pos.x])
         self.light = drawing.Quad(globals.light_quads)
-        self.light.set_vertices(self.ground.bottom_left, self.ground.ceiling_right, 0)
+        self.set_light_vertices()
 
         self.top_bar = ui.Box(
             parent=globals.screen_root, pos=Point(0, 0.9), tr=Point(1, 1), colour=(0.2, 0.2, 0.2, 0.7)
@@ -2072,16 +3013,14 @@ class GameView(ui.RootElement):
         # self.ground = None
         self.drone = None
         self.packages = []
-        self.receivers = []
-        self.houses = []
-        self.fences = []
-        self.chargers = []
-        self.mailbox_lookup = {}
+        self.fleet = None
+        self.snapshot = None
         self.tutorial = None
 
         self.level_text = None
         self.score = 0
 
+        self.collisions = CollisionEvents()
         self.bottom_handler = globals.space.add_collision_handler(CollisionTypes.DRONE, CollisionTypes.BOTTOM)
         self.box_handlers = [
             globals.space.add_collision_handler(CollisionTypes.BOX, item_type)
@@ -2132,6 +3071,13 @@ class GameView(ui.RootElement):
         self.top_bar.disable()
         self.bottom_bar.disable()
 
+        self.autopilot = None
+        if globals.config.autopilot:
+            # Straight into free flying, which goes on forever
+            self.autopilot = Autopilot(self)
+            free_flying = next(i for i, level in enumerate(self.levels) if level.infinite)
+            self.main_menu.start_level(None, free_flying)
+
         # Skip the main menu for now
         # self.main_menu.disable()
         # self.main_menu.start_level(0, 0)
@@ -2165,67 +3111,88 @@ class GameView(ui.RootElement):
         if self.tutorial:
             self.tutorial.thrust_adjust(diff)
 
-    def bottom_collision_start(self, arbiter, space, data):
-        # If two vertices are *very* close to the floor, we can turn off the engine
-        # print(f"{self.drone.landed()}")
-        if self.drone.landed():
-            self.drone.on_ground = globals.game_time
-        # if self.drone.landed() and not self.drone.flying():
-        #    self.drone.engine = False
+    # These are called from inside the physics step, so they only record what happened for process_collisions
 
+    def bottom_collision_start(self, arbiter, space, data):
+        self.collisions.add((CollisionEvents.BOTTOM_START, arbiter.shapes, 0))
         return True
 
     def bottom_collision_end(self, arbiter, space, data):
-        self.drone.on_ground = None
+        self.collisions.add((CollisionEvents.BOTTOM_END, arbiter.shapes, 0))
         return True
 
     def charger_start(self, arbiter, space, data):
-        self.drone.mark_on_charger(True)
+        self.collisions.add((CollisionEvents.CHARGER_START, arbiter.shapes, 0))
         return True
 
     def charger_end(self, arbiter, space, data):
-        self.drone.mark_on_charger(False)
+        self.collisions.add((CollisionEvents.CHARGER_END, arbiter.shapes, 0))
 
     def receiver_start(self, arbiter, space, data):
-        ids = [shape.parent for shape in arbiter.shapes]
-        if ids[0].id != ids[1].id:
-            return True
-
-        receiver, package = ids
-        if not package.is_package:
-            receiver, package = package, receiver
-
-        package.mark_on_receiver(True)
-        package.parent.set_mailbox_flag(package.id, True)
-
+        self.collisions.add((CollisionEvents.RECEIVER_START, arbiter.shapes, 0))
         return True
 
     def receiver_end(self, arbiter, space, data):
-        ids = [shape.parent for shape in arbiter.shapes]
-        if ids[0].id != ids[1].id:
-            return True
+        self.collisions.add((CollisionEvents.RECEIVER_END, arbiter.shapes, 0))
+        return True
 
-        receiver, package = ids
-        if not package.is_package:
-            receiver, package = package, receiver
+    def box_post_solve(self, arbiter, space, data):
+        if arbiter.is_first_contact and arbiter.total_ke >= CollisionEvents.min_jostle_ke:
+            self.collisions.add((CollisionEvents.JOSTLE, arbiter.shapes, arbiter.total_ke))
+        return True
 
-        package.mark_on_receiver(False)
-        package.parent.set_mailbox_flag(package.id, False)
+    def process_collisions(self):
+        """Deal with everything that hit everything else during this frame's physics"""
+        jostles = {}
+        for kind, shapes, ke in self.collisions.take():
+            if kind == CollisionEvents.JOSTLE:
+                for shape in shapes:
+                    if isinstance(shape.parent, Package) and shape.parent.in_world:
+                        jostles[shape.parent] = jostles.get(shape.parent, 0) + ke
+
+            elif kind in CollisionEvents.drone_kinds and not any(shape.parent is self.drone for shape in shapes):
+                # Separations from when an old drone was removed
+                pass
+
+            elif kind == CollisionEvents.BOTTOM_START:
+                self.drone.ground_contacts.add(shapes[1])
+                # If two vertices are *very* close to the floor, we can turn off the engine
+                if self.drone.landed():
+                    self.drone.on_ground = globals.game_time
+            elif kind == CollisionEvents.BOTTOM_END:
+                self.drone.ground_contacts.discard(shapes[1])
+                # Leaving one segment while still on the next one along doesn't count as taking off
+                if not self.drone.ground_contacts:
+                    self.drone.on_ground = None
+
+            elif kind == CollisionEvents.CHARGER_START:
+                self.drone.mark_on_charger(True)
+            elif kind == CollisionEvents.CHARGER_END:
+                self.drone.mark_on_charger(False)
 
-        return True
+            else:
+                self.receiver_contact(shapes, kind == CollisionEvents.RECEIVER_START)
 
-    def box_post_solve(self, arbiter, space, data):
-        if not arbiter.is_first_contact or arbiter.total_ke < 150:
-            return
+        # However many times a package got knocked about this frame, it only takes the damage and makes the noise
+        # once
+        for package, ke in jostles.items():
+            package.jostle(ke / 300)
+        if jostles:
+            globals.audio.schedule("bang")
 
-        for shape in arbiter.shapes:
-            if not isinstance(shape.parent, Package):
-                continue
-            package = shape.parent
-            package.jostle(arbiter.total_ke / 300)
-            globals.sounds.bang.play()
+    def receiver_contact(self, shapes, on_receiver):
+        receiver, package = (shape.parent for shape in shapes)
+        if not package.is_package:
+            receiver, package = package, receiver
+        # Fleet packages land on the receivers too, but they aren't anyone's delivery
+        if not package.is_package or package.id != receiver.id:
+            return
 
-        return True
+        # Removing a package from the space separates it from its receiver, but by the time we hear about it
+        # there may be a new package on the clock, so all that's left to do is the flag
+        if package.in_world:
+            package.mark_on_receiver(on_receiver)
+        package.parent.set_mailbox_flag(package.id, on_receiver)
 
     def quit(self, pos):
         raise SystemExit()
@@ -2267,14 +3234,14 @@ class GameView(ui.RootElement):
             self.sub_text = None
         self.text_fade = False
 
-        for item in itertools.chain(self.packages, self.receivers, self.houses, self.fences, self.chargers):
+        for item in self.packages:
             item.delete()
 
         self.packages = []
-        self.receivers = []
-        self.fences = []
-        self.chargers = []
-        self.houses = []
+        # Starting the same level again just puts it back how it was, otherwise we build it from scratch
+        restart = self.snapshot is not None and self.snapshot.level is level
+        if not restart:
+            self.streamer.delete()
 
         if self.tutorial:
             self.tutorial.delete()
@@ -2282,27 +3249,16 @@ class GameView(ui.RootElement):
         if level.tutorial:
             self.tutorial = Tutorial(self)
 
-        self.mailbox_lookup = {}
+        if restart:
+            self.snapshot.restore(self)
+        else:
+            # The receivers, houses and so on get made chunk by chunk as the drone gets near them
+            self.streamer = WorldStreamer(self, level)
+            self.streamer.update([level.start_pos.x])
+        self.set_light_vertices()
 
         # We're going to generate a random package for delivery
 
-        for i, pos in enumerate(level.receivers):
-            self.receivers.append(Receiver(self, pos, id=i))
-            self.houses.append(House(self, pos + 50, 0))
-            mailbox = Mailbox(self, i, pos - 50, 0)
-            self.houses.append(mailbox)
-            self.mailbox_lookup[mailbox.id] = mailbox
-
-        # Hack, put some fences up the left side
-        for y in range(0, 1000, Fence.size.y):
-            self.fences.append(Fence(self, -80, y))
-
-        for pos in level.fences:
-            self.fences.append(Fence(self, pos))
-
-        for pos in level.chargers:
-            self.chargers.append(Charger(self, pos, id=0))
-
         self.level_items = level.items[::]
 
         try:
@@ -2310,16 +3266,24 @@ class GameView(ui.RootElement):
         except IndexError:
             # An initial empty list means random!
             package_info = level.get_random_package()
-            package_info.target = random.randint(0, len(self.receivers) - 1)
+            package_info.target = self.streamer.random_target()
         self.create_package(package_info)
 
         # if self.ground:
         #    self.ground.delete()
 
-        if self.drone:
-            self.drone.delete()
-        # self.ground = Ground(self, level.ground_height)
-        self.drone = Drone(self, level.start_pos)
+        if self.fleet:
+            self.fleet.delete()
+            self.fleet = None
+        if globals.config.fleet:
+            self.fleet = Fleet(self, globals.config.fleet, level.start_pos + Point(40, 0))
+
+        if not restart:
+            if self.drone:
+                self.drone.delete()
+            # self.ground = Ground(self, level.ground_height)
+            self.drone = Drone(self, level.start_pos)
+            self.snapshot = LevelSnapshot(level, self.drone)
         # This will initialise the thrust
         self.thrust_slider.scroll(0)
         self.viewpos.set_follow_target(self.drone)
@@ -2341,7 +3305,11 @@ class GameView(ui.RootElement):
         #    self.cup.reset_line()
 
     def set_mailbox_flag(self, id, state):
-        self.mailbox_lookup[id].set_flag(state)
+        try:
+            self.streamer.mailbox_lookup[id].set_flag(state)
+        except KeyError:
+            # Its chunk isn't loaded, so there's nobody to see it
+            pass
 
     def create_package(self, info):
         self.current_info = info
@@ -2401,7 +3369,7 @@ class GameView(ui.RootElement):
         if len(self.level_items) == 0:
             if level.infinite:
                 info = level.get_random_package()
-                info.target = random.randint(0, len(self.receivers) - 1)
+                info.target = self.streamer.random_target()
             else:
                 if self.score > self.high_scores[self.current_level]:
                     self.high_scores[self.current_level] = self.score
@@ -2447,7 +3415,7 @@ class GameView(ui.RootElement):
         level.items = [
             (
                 Point(15 + random.randint(1, 20), 15 + random.randint(1, 20)),
-                random.randint(0, len(self.receivers) - 1),
+                self.streamer.random_target(),
             )
             for i in range(100)
         ]
@@ -2561,9 +3529,10 @@ class GameView(ui.RootElement):
 
         globals.game_time = globals.time - self.game_time_diff
 
-        for x in range(25):  # 10 iterations to get a more stable simulation
+        for x in range(globals.physics_substeps):  # lots of small steps to get a more stable simulation
             globals.current_view.apply_forces()
             globals.space.step(globals.dt)
+        self.process_collisions()
 
         if self.package_start is not None:
             text, colour = format_time(self.get_package_time())
@@ -2591,9 +3560,13 @@ class GameView(ui.RootElement):
         # self.ball.body.position = globals.mouse_screen
         # self.ball.set_pos(globals.mouse_pos)
 
-        self.drone.update()
-        for package in itertools.chain(self.packages, self.receivers):
-            package.update()
+        # Move all the dynamic quads to where the physics has put them, and update whatever needs it. Receivers
+        # are static, their quads never need updating
+        self.updates.update()
+        if self.fleet:
+            self.fleet.update()
+        if self.autopilot:
+            self.autopilot.update()
 
         # if self.thrown:
         #     diff = self.ball.body.position - self.last_ball_pos
@@ -2608,10 +3581,30 @@ class GameView(ui.RootElement):
         self.viewpos.update()
         globals.mouse_world = self.viewpos.pos + to_world_coords(self.mouse_pos)
 
+        # Keep the world loaded around the view and around the packages, so they don't fall out of it
+        focus = [self.viewpos.pos.x + globals.screen.x / globals.scale.x * 0.5]
+        focus.extend(from_phys_coords(package.body.position.x) for package in self.packages)
+        if self.fleet:
+            focus.extend(self.fleet.focus())
+        if self.streamer.update(focus):
+            self.set_light_vertices()
+
+    def set_light_vertices(self):
+        # The ambient light only needs to cover what's loaded
+        left, right = self.streamer.extent()
+        bl = Point(left, -self.streamer.level.ground_height)
+        self.light.set_vertices(bl, Point(right, Ground.ceiling), 0)
+
     def draw(self):
+        # This has to look at the static buffer before drawing it uploads any changes
+        self.shadow_cache.update(self)
         # drawing.draw_no_texture(globals.ui_buffer)
         drawing.scale(*globals.scale, 1)
         drawing.translate(*-(self.viewpos.pos), 0)
+        # Only the static quads near the view get drawn, with a bit of margin either side
+        left = self.viewpos.pos.x - self.cull_margin
+        right = self.viewpos.pos.x + globals.screen.x / globals.scale.x + self.cull_margin
+        drawing.draw_static(globals.static_quad_buffer, self.atlas.texture, left, right)
         drawing.draw_all(globals.quad_buffer, self.atlas.texture)
 
     def mouse_motion(self, pos, rel, handled):
@@ -2776,3 +3769,5 @@ class GameView(ui.RootElement):
     def apply_forces(self):
         if self.drone:
             self.drone.apply_forces()
+        if self.fleet:
+            self.fleet.apply_forces()
@@ -1,5 +1,6 @@
 screen = None
 quad_buffer = None
+static_quad_buffer = None
 ui_buffer = None
 nonstatic_text_buffer = None
 colour_tiles = None
@@ -11,3 +12,12 @@ dragging = None
 player_config = None
 screen_root = None
 time = 0
+assets = None
+start_time = None
+config = None
+audio = None
+text_arena = None
+frame_snapshot = None
+frame_scheduler = None
+frame_recorder = None
+physics_substeps = 25
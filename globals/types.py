@@ -109,10 +109,69 @@ class Point(object):
 class Directories:
     def __init__(self, base):
         self.resource = base
-        for name in "sprites", "foreground", "computer", "cursor", "music":
+        for name in "sprites", "foreground", "computer", "cursor", "music", "sounds":
             setattr(self, name, os.path.join(base, name))
 
 
+class Config(object):
+    """
+    Tunable settings. Any of them can be overridden by an environment variable named after it in upper case with a
+    MOBILE_DRONE_ prefix, so MOBILE_DRONE_SOUND_BUDGET for sound_budget
+    """
+
+    defaults = {
+        # Roughly how many bytes of decoded audio we keep around
+        "sound_budget": 16 * 1024 * 1024,
+        # Mixer channels reserved for effects, and how many of them one sound can use at a time
+        "audio_channels": 8,
+        "max_voices": 2,
+        # Triggers of the same sound closer together than this many ms are played once
+        "sound_window": 80,
+        # Frame cap, one of 30, 60 or 120, or 0 for uncapped. With vsync on the display sets the pace instead
+        "target_fps": 60,
+        "vsync": False,
+        # Lower the shadow quality and number of lights when frames are taking too long
+        "quality_governor": True,
+        # Frame cap while the game is paused behind a menu
+        "paused_fps": 30,
+        # Seconds a body has to be at rest before the physics lets it sleep, or 0 to never sleep
+        "sleep_time": 0.5,
+        # Threads for the physics solver. More than 1 uses pymunk's threaded space, which only helps on platforms
+        # that support it (not Windows)
+        "physics_threads": 1,
+        # Use a spatial hash for the broadphase instead of the default bounding box tree. The cell size should be
+        # around the size of a package, and the count a bit more than the number of shapes
+        "use_spatial_hash": False,
+        "spatial_hash_dim": 50.0,
+        "spatial_hash_count": 10000,
+        # How many AI drones to fly about delivering packages alongside the player
+        "fleet": 0,
+        # Let the autopilot fly the free flying level, for benchmarks and soak runs. soak_time is how many seconds
+        # to run for before quitting, or 0 to carry on until stopped
+        "autopilot": False,
+        "soak_time": 0,
+        # Write a line of CSV for every frame to this file
+        "frame_log": "",
+        # Seed for the random numbers, so runs can be repeated. Negative means don't seed
+        "seed": -1,
+        # Print the startup time, and the frame time, update, collision and input stats when we quit
+        "report_stats": False,
+    }
+
+    def __init__(self, **overrides):
+        for name, default in self.defaults.items():
+            value = os.environ.get("MOBILE_DRONE_" + name.upper())
+            if name in overrides:
+                value = overrides[name]
+            elif value is None:
+                value = default
+            elif isinstance(default, bool):
+                value = value.lower() in ("1", "true", "yes", "on")
+            else:
+                value = type(default)(value)
+            setattr(self, name, value)
+
+
 class Segment(pymunk.Segment):
     def __init__(self, body, a, b, radius):
         super().__init__(body, tuple(a), tuple(b), radius)
@@ -4,8 +4,11 @@ import globals
 import drawing
 from globals.types import Point, Segment
 import sounds
+import assets
 import game
+import frames
 import pymunk
+import random
 import sys
 import time
 import os
@@ -17,8 +20,22 @@ def light_lister():
         yield light
 
 
+def new_space(config):
+    """Create a Space which contain the simulation"""
+    threads = config.physics_threads
+    space = pymunk.Space(threaded=threads > 1)
+    if threads > 1:
+        space.threads = threads
+    if config.use_spatial_hash:
+        space.use_spatial_hash(config.spatial_hash_dim, config.spatial_hash_count)
+    space.gravity = (0.0, -300.0)
+    space.damping = 0.999  # to prevent it from blowing up.
+    return space
+
+
 def init():
     """Initialise everything. Run once on startup"""
+    globals.start_time = time.time()
     if hasattr(sys, "_MEIPASS"):
         os.chdir(sys._MEIPASS)
 
@@ -31,6 +48,12 @@ def init():
     w, h = (1280, 960)
 
     globals.dirs = globals.types.Directories("resource")
+    globals.config = globals.types.Config()
+    if globals.config.seed >= 0:
+        random.seed(globals.config.seed)
+    # Get the decoding started as early as possible so it overlaps with the GL setup
+    globals.assets = assets.AssetLoader(globals.dirs.resource)
+    globals.assets.prefetch(assets.startup_assets())
 
     globals.screen = Point(w, h)
     globals.scale = Point(3, 3)
@@ -51,13 +74,16 @@ def init():
     globals.light_lister = light_lister
 
     globals.quad_buffer = drawing.QuadBuffer(131072)
+    globals.static_quad_buffer = drawing.StaticQuadBuffer(131072)
     globals.light_quads = drawing.QuadBuffer(16384)
     globals.nightlight_quads = drawing.QuadBuffer(16)
     globals.nonstatic_text_buffer = drawing.QuadBuffer(131072)
+    globals.text_arena = drawing.QuadArena(16384)
     globals.screen_quadbuffer = drawing.QuadBuffer(16)
-    globals.space = pymunk.Space()  # Create a Space which contain the simulation
-    globals.space.gravity = (0.0, -300.0)
-    globals.space.damping = 0.999  # to prevent it from blowing up.
+    globals.space = new_space(globals.config)
+    if globals.config.sleep_time:
+        # Resting bodies can then be skipped by the update scheduler
+        globals.space.sleep_time_threshold = globals.config.sleep_time
 
     # Hackeroo
     globals.temp_mouse_light = drawing.QuadBuffer(16)
@@ -68,9 +94,9 @@ def init():
     globals.screen.full_quad.set_vertices(Point(0, 0), globals.screen, 0.01)
     globals.ui_buffer = drawing.QuadBuffer(131072, ui=True)
     globals.screen_relative = drawing.QuadBuffer(131072, ui=True)
-    globals.shadow_quadbuffer = drawing.ShadowQuadBuffer(256 * 4)
+    globals.shadow_quadbuffer = drawing.ShadowQuadBuffer(256 * 4, rows=int(globals.screen.y))
     globals.line_buffer = drawing.LineBuffer(131072)
-    globals.sounds = sounds.Sounds()
+    globals.sounds = sounds.Sounds(globals.config.sound_budget)
 
     globals.mouse_relative_text = drawing.QuadBuffer(1024, ui=True, mouse_relative=True)
 
@@ -80,109 +106,256 @@ def init():
     globals.mouse_screen = Point(0, 0)
     globals.tiles = None
 
-    pygame.init()
-    screen = pygame.display.set_mode((w, h), pygame.OPENGL | pygame.DOUBLEBUF)
+    # Only the display to begin with. pygame.init would open the audio device too, and that can wait for the window
+    pygame.display.init()
+    screen = pygame.display.set_mode(
+        (w, h), pygame.OPENGL | pygame.DOUBLEBUF, vsync=1 if globals.config.vsync else 0
+    )
     pygame.display.set_caption("LD53")
+    # Nothing else gets looked at, so it isn't let into the queue at all
+    pygame.event.set_blocked(None)
+    pygame.event.set_allowed(input_event_types)
+    sounds.init()
+    # Now the rest of pygame. The mixer is already going, so this leaves it alone
+    pygame.init()
+    globals.audio = sounds.AudioScheduler(
+        globals.sounds,
+        num_channels=globals.config.audio_channels,
+        window=globals.config.sound_window,
+        max_voices=globals.config.max_voices,
+    )
     pygame.mouse.set_visible(False)
     drawing.init(*globals.screen)
-    globals.cursor = drawing.cursors.Cursor()
-
-    globals.text_manager = drawing.texture.TextManager()
-
+    globals.frame_snapshot = drawing.texture.FrameSnapshot(globals.screen)
+    globals.frame_scheduler = frames.FrameScheduler(
+        globals.config.target_fps,
+        vsync=globals.config.vsync,
+        governor=frames.QualityGovernor(globals.config.quality_governor),
+    )
+    if globals.config.frame_log:
+        globals.frame_recorder = frames.FrameRecorder(globals.config.frame_log)
+
+
+def loading_screen():
+    """Show a progress bar until the asset loader has finished everything requested so far"""
+    buffer = drawing.QuadBuffer(16, ui=True)
+    border = drawing.Quad(buffer)
+    background = drawing.Quad(buffer)
+    bar = drawing.Quad(buffer)
+    bl = Point(globals.screen.x * 0.25, globals.screen.y * 0.48)
+    tr = Point(globals.screen.x * 0.75, globals.screen.y * 0.52)
+    border.set_vertices(bl - Point(2, 2), tr + Point(2, 2), drawing.constants.DrawLevels.ui)
+    border.set_colour(drawing.constants.colours.white)
+    background.set_vertices(bl, tr, drawing.constants.DrawLevels.ui + 1)
+    background.set_colour((0, 0, 0, 1))
+    bar.set_colour(drawing.constants.colours.white)
+    clock = pygame.time.Clock()
 
-def main_run():
+    while True:
+        for event in pygame.event.get():
+            if event.type == pygame.locals.QUIT:
+                raise SystemExit
 
-    done = False
-    last = 0
-    clock = pygame.time.Clock()
-    last_handled = False
+        finished, total = globals.assets.progress()
+        partial = finished / total if total else 1
+        bar.set_vertices(bl, Point(bl.x + (tr.x - bl.x) * partial, tr.y), drawing.constants.DrawLevels.ui + 2)
 
-    while not done:
+        drawing.clear_screen()
+        drawing.draw_no_texture(buffer)
+        drawing.draw_ui()
+        pygame.display.flip()
 
-        clock.tick(60)
-        t = pygame.time.get_ticks()
-        fps = clock.get_fps()
-        if t - last > 1000:
-            last = t
+        if finished == total:
+            break
+        clock.tick(30)
+
+    for quad in border, background, bar:
+        quad.delete()
+
+
+# The only events main_run needs. Everything else is blocked from the queue in init. TEXTINPUT isn't handled
+# itself, but pygame fills in KEYDOWN's unicode from it, so it has to be let through
+input_event_types = [
+    pygame.QUIT,
+    pygame.KEYDOWN,
+    pygame.KEYUP,
+    pygame.TEXTINPUT,
+    pygame.MOUSEMOTION,
+    pygame.MOUSEBUTTONDOWN,
+    pygame.MOUSEBUTTONUP,
+]
+
+
+class InputStats(object):
+    """Keeps count of how many events we get each frame, and how many are left after coalescing"""
+
+    def __init__(self):
+        self.frames = 0
+        self.raw = 0
+        self.processed = 0
+        self.max_raw = 0
+
+    def add(self, raw, processed):
+        self.frames += 1
+        self.raw += raw
+        self.processed += processed
+        self.max_raw = max(self.max_raw, raw)
+
+    def report(self):
+        if not self.frames:
+            return
+        print(
+            f"Input events per frame: {self.raw / self.frames:.2f} received, "
+            f"{self.processed / self.frames:.2f} handled, {self.max_raw} at most"
+        )
+
+
+def coalesce_motion(events):
+    """
+    Collapse each run of consecutive MOUSEMOTION events into one with the final position and the summed relative
+    motion. Motion either side of a button or key event isn't merged, so the order of things is kept
+    """
+    out = []
+    for event in events:
+        if event.type == pygame.MOUSEMOTION and out and out[-1].type == pygame.MOUSEMOTION:
+            last = out[-1]
+            out[-1] = pygame.event.Event(
+                pygame.MOUSEMOTION,
+                pos=event.pos,
+                rel=(last.rel[0] + event.rel[0], last.rel[1] + event.rel[1]),
+                buttons=event.buttons,
+            )
+        else:
+            out.append(event)
+    return out
 
-        globals.t = globals.time = t
 
-        if fps == 0:
-            fps = 50
-        iterations = 25
-        globals.dt = 1.0 / float(fps) / float(iterations)
+def main_run():
 
-        drawing.new_frame()
-        globals.current_view.update(t)
-        globals.current_view.draw()
+    done = False
+    last_handled = False
+    input_stats = InputStats()
 
-        # drawing.draw_no_texture(globals.ui_buffer)
+    # Escape quits by raising SystemExit, so report from a finally to catch that too
+    try:
+        while not done:
+
+            # While the game's paused behind a menu the scene doesn't change, so we draw it once, keep a copy and
+            # just put that copy behind the ui until it's unpaused. There's no need to go as fast either
+            frozen = globals.current_view.paused
+            ms = globals.frame_scheduler.tick(globals.config.paused_fps if frozen else None)
+            t = pygame.time.get_ticks()
+
+            globals.t = globals.time = t
+            globals.dt = globals.frame_scheduler.frame_time / globals.physics_substeps
+
+            if not frozen:
+                globals.frame_snapshot.invalidate()
+            use_snapshot = frozen and globals.frame_snapshot.valid
+
+            if not use_snapshot:
+                drawing.new_frame()
+            globals.current_view.update(t)
+            # Any sounds triggered during the physics steps get played here, once
+            globals.audio.drain(t)
+            # Any ui that moved this frame gets laid out once here
+            globals.current_view.layout()
+            globals.screen_root.layout()
+
+            if use_snapshot:
+                globals.frame_snapshot.draw()
+            else:
+                globals.current_view.draw()
 
-        drawing.line_width(2)
-        drawing.draw_no_texture(globals.line_buffer)
+                # drawing.draw_no_texture(globals.ui_buffer)
 
-        drawing.end_frame()
-        globals.screen_root.draw()
-        globals.text_manager.draw()
-        globals.cursor.draw()
+                drawing.line_width(2)
+                drawing.draw_no_texture(globals.line_buffer)
 
-        drawing.draw_ui()
+                drawing.end_frame()
+                if frozen:
+                    globals.frame_snapshot.take()
+            globals.screen_root.draw()
+            globals.text_manager.draw()
+            globals.cursor.draw()
 
-        pygame.display.flip()
+            drawing.draw_ui()
 
-        eventlist = pygame.event.get()
-        for event in eventlist:
-            if event.type == pygame.locals.QUIT:
+            globals.frame_scheduler.flipping()
+            pygame.display.flip()
+            if globals.frame_recorder:
+                globals.frame_recorder.record(t, ms, globals.game_view)
+            if globals.config.soak_time and t > globals.config.soak_time * 1000:
                 done = True
-                break
-
-            elif event.type == pygame.KEYDOWN:
-                try:
-                    key = ord(event.unicode)
-                except (AttributeError, TypeError):
-                    key = event.key
-
-                globals.current_view.key_down(key)
-            elif event.type == pygame.KEYUP:
-                try:
-                    key = ord(event.unicode)
-                except (AttributeError, TypeError):
-                    key = event.key
-
-                globals.current_view.key_up(key)
-            else:
-                try:
-                    pos = Point(event.pos[0], globals.screen[1] - event.pos[1])
-                except AttributeError:
-                    continue
-                if event.type == pygame.MOUSEMOTION:
-                    rel = Point(event.rel[0], -event.rel[1])
-                    globals.mouse_screen = pos
-                    if globals.dragging:
-                        globals.dragging.mouse_motion(pos, rel, False)
-                    else:
-                        handled = globals.screen_root.mouse_motion(pos, rel, False)
-                        # Only cancel the mouse motion if wasn't cancelled already
-                        if handled and not last_handled:
-                            globals.current_view.cancel_mouse_motion()
-                        last_handled = handled
-                        globals.current_view.mouse_motion(pos, rel, True if handled else False)
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    for layer in globals.screen_root, globals.current_view:
-                        handled, dragging = layer.mouse_button_down(pos, event.button)
-                        if handled and dragging:
-                            globals.dragging = dragging
-                            break
-                        if handled:
-                            break
-
-                elif event.type == pygame.MOUSEBUTTONUP:
-                    for layer in globals.screen_root, globals.current_view:
-                        handled, dragging = layer.mouse_button_up(pos, event.button)
-                        if handled and not dragging:
-                            globals.dragging = None
-                        if handled:
-                            break
+            if globals.start_time is not None:
+                if globals.config.report_stats:
+                    print(f"Time to first frame: {time.time() - globals.start_time:.2f}s")
+                globals.start_time = None
+
+            eventlist = pygame.event.get()
+            events = coalesce_motion(eventlist)
+            input_stats.add(len(eventlist), len(events))
+            for event in events:
+                if event.type == pygame.locals.QUIT:
+                    done = True
+                    break
+
+                elif event.type == pygame.KEYDOWN:
+                    try:
+                        key = ord(event.unicode)
+                    except (AttributeError, TypeError):
+                        key = event.key
+
+                    globals.current_view.key_down(key)
+                elif event.type == pygame.KEYUP:
+                    try:
+                        key = ord(event.unicode)
+                    except (AttributeError, TypeError):
+                        key = event.key
+
+                    globals.current_view.key_up(key)
+                else:
+                    try:
+                        pos = Point(event.pos[0], globals.screen[1] - event.pos[1])
+                    except AttributeError:
+                        continue
+                    if event.type == pygame.MOUSEMOTION:
+                        rel = Point(event.rel[0], -event.rel[1])
+                        globals.mouse_screen = pos
+                        if globals.dragging:
+                            globals.dragging.mouse_motion(pos, rel, False)
+                        else:
+                            handled = globals.screen_root.mouse_motion(pos, rel, False)
+                            # Only cancel the mouse motion if wasn't cancelled already
+                            if handled and not last_handled:
+                                globals.current_view.cancel_mouse_motion()
+                            last_handled = handled
+                            globals.current_view.mouse_motion(pos, rel, True if handled else False)
+                    elif event.type == pygame.MOUSEBUTTONDOWN:
+                        for layer in globals.screen_root, globals.current_view:
+                            handled, dragging = layer.mouse_button_down(pos, event.button)
+                            if handled and dragging:
+                                globals.dragging = dragging
+                                break
+                            if handled:
+                                break
+
+                    elif event.type == pygame.MOUSEBUTTONUP:
+                        for layer in globals.screen_root, globals.current_view:
+                            handled, dragging = layer.mouse_button_up(pos, event.button)
+                            if handled and not dragging:
+                                globals.dragging = None
+                            if handled:
+                                break
+    finally:
+        if globals.config.report_stats:
+            input_stats.report()
+            globals.frame_scheduler.histogram.report()
+            globals.game_view.updates.report()
+            globals.game_view.collisions.report()
+            globals.game_view.shadow_cache.report()
+        if globals.frame_recorder:
+            globals.frame_recorder.close()
 
 
 def main():
@@ -195,7 +368,10 @@ def main():
     globals.dragging = None
 
     drawing.init_drawing()
+    loading_screen()
 
+    globals.cursor = drawing.cursors.Cursor()
+    globals.text_manager = drawing.texture.TextManager()
     globals.game_view = game.GameView()
     globals.current_view = globals.game_view
 
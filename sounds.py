@@ -1,19 +1,126 @@
 import sys, pygame, glob, os
+import collections
 
 from pygame.locals import *
 import pygame.mixer
+import globals
 
-pygame.mixer.init()
+# bytes per second of decoded audio, set once the mixer is up
+bytes_per_second = 0
+
+
+def init():
+    """Start the mixer. Needs to happen after the window is up"""
+    global bytes_per_second
+    pygame.mixer.init()
+    frequency, size, channels = pygame.mixer.get_init()
+    bytes_per_second = frequency * (abs(size) // 8) * channels
 
 
 class Sounds(object):
-    def __init__(self):
+    """
+    Sounds are decoded the first time they're used and kept in an LRU that's trimmed down to the configured budget,
+    so the ones that are rarely played get dropped until they're next needed. Sounds that are playing are never
+    evicted
+    """
+
+    def __init__(self, budget):
         self.talking = []
         self.player_damage = []
+        self.budget = budget
+        self.used = 0
+        self.resident = collections.OrderedDict()
+        self.filenames = {}
 
-        for filename in glob.glob(os.path.join("resource", "sounds", "*.ogg")):
-            sound = pygame.mixer.Sound(filename)
-            sound.set_volume(0.6)
+        for filename in glob.glob(os.path.join(globals.dirs.sounds, "*.ogg")):
             name = os.path.basename(filename)
             name = os.path.splitext(name)[0]
-            setattr(self, name, sound)
+            self.filenames[name] = os.path.relpath(filename, globals.dirs.resource)
+
+    def __getattr__(self, name):
+        # We never set the sounds as attributes, so every access comes through here and keeps the LRU up to date
+        try:
+            filename = self.__dict__["filenames"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+        try:
+            sound, size = self.resident[name]
+            self.resident.move_to_end(name)
+            return sound
+        except KeyError:
+            pass
+
+        sound = globals.assets.get(filename)
+        sound.set_volume(0.6)
+        size = int(sound.get_length() * bytes_per_second)
+        self.resident[name] = (sound, size)
+        self.used += size
+        self.trim()
+        return sound
+
+    def trim(self):
+        # The most recent one is about to be played so it always stays
+        for name in list(self.resident.keys())[:-1]:
+            if self.used <= self.budget:
+                break
+            sound, size = self.resident[name]
+            if sound.get_num_channels() > 0:
+                continue
+            del self.resident[name]
+            self.used -= size
+            globals.assets.forget(self.filenames[name])
+
+
+class AudioScheduler(object):
+    """
+    Plays short effects from a fixed pool of reserved mixer channels. Triggers are queued with schedule, which is
+    safe to call from inside the physics step, and only played when drain is called once a frame. Repeats of the
+    same sound within a window are coalesced into one, and each sound can only have so many voices at once
+    """
+
+    def __init__(self, sounds, num_channels=8, window=80, max_voices=2):
+        self.sounds = sounds
+        self.window = window
+        self.max_voices = max_voices
+        # Reserved channels are the first ones, and won't be picked by Sound.play, so add them on top of the
+        # existing ones rather than taking them away from everything else
+        pygame.mixer.set_num_channels(pygame.mixer.get_num_channels() + num_channels)
+        pygame.mixer.set_reserved(num_channels)
+        self.channels = [pygame.mixer.Channel(i) for i in range(num_channels)]
+        self.channel_names = [None] * num_channels
+        self.pending = collections.OrderedDict()
+        self.last_played = {}
+
+    def schedule(self, name):
+        self.pending[name] = self.pending.get(name, 0) + 1
+
+    def voices(self, name):
+        return sum(
+            1
+            for channel, channel_name in zip(self.channels, self.channel_names)
+            if channel_name == name and channel.get_busy()
+        )
+
+    def free_channel(self):
+        for i, channel in enumerate(self.channels):
+            if not channel.get_busy():
+                return i
+
+    def drain(self, t):
+        pending = self.pending
+        self.pending = collections.OrderedDict()
+
+        for name in pending:
+            last = self.last_played.get(name)
+            if last is not None and t - last < self.window:
+                continue
+            if self.voices(name) >= self.max_voices:
+                continue
+            i = self.free_channel()
+            if i is None:
+                # Every channel is busy, dropping an effect is better than cutting one off
+                break
+            self.channels[i].play(getattr(self.sounds, name))
+            self.channel_names[i] = name
+            self.last_played[name] = t
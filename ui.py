@@ -2,6 +2,7 @@ import globals
 import drawing
 from globals.types import Point
 import bisect
+import numpy
 import pygame
 
 
@@ -15,28 +16,41 @@ class UIState(object):
 
 class UIElementList:
     """
-    Very basic implementation of a list of UIElements that can be looked up by position.
-    It's using an O(n) algorithm, and I'm sure I can do better once everything's working
+    A list of UIElements that can be looked up by position. Elements are binned into a uniform grid over their
+    absolute bounds, and each cell is kept sorted by level, so a lookup only checks the few elements in the cell
+    under the cursor, highest first.
+
+    Elements are keyed by id rather than hash, as their hash changes when they move
     """
 
+    cell_size = 64
+
     def __init__(self):
+        # id -> (element, level)
         self.items = {}
+        # cell -> ([-level, ...], [element, ...]), sorted by descending level
+        self.cells = {}
+        self.element_cells = {}
 
     def __setitem__(self, item, value):
-        self.items[item] = value
+        if id(item) in self.items:
+            self.unbin(item)
+        self.items[id(item)] = (item, value)
+        self.bin(item, value)
 
     def __delitem__(self, item):
-        del self.items[item]
+        del self.items[id(item)]
+        self.unbin(item)
 
     def __contains__(self, item):
-        return item in self.items
+        return id(item) in self.items
 
     def __str__(self):
         return repr(self)
 
     def __repr__(self):
         out = ["UIElementList:"]
-        for item in self.items:
+        for item in self.elements():
             out.append(
                 "%s:%s - %s(%s)"
                 % (
@@ -48,14 +62,62 @@ class UIElementList:
             )
         return "\n".join(out)
 
+    def elements(self):
+        return [item for item, level in self.items.values()]
+
+    def cell(self, pos):
+        return int(pos.x // self.cell_size), int(pos.y // self.cell_size)
+
+    def covered_cells(self, item):
+        left, bottom = self.cell(item.absolute.bottom_left)
+        right, top = self.cell(item.absolute.top_right)
+        for x in range(left, right + 1):
+            for y in range(bottom, top + 1):
+                yield x, y
+
+    def bin(self, item, level):
+        cells = list(self.covered_cells(item))
+        for cell in cells:
+            try:
+                levels, elements = self.cells[cell]
+            except KeyError:
+                levels, elements = self.cells[cell] = ([], [])
+            # bisect_right so that of elements with the same level, the first registered wins
+            index = bisect.bisect_right(levels, -level)
+            levels.insert(index, -level)
+            elements.insert(index, item)
+        self.element_cells[id(item)] = cells
+
+    def unbin(self, item):
+        for cell in self.element_cells.pop(id(item), []):
+            levels, elements = self.cells[cell]
+            for i, element in enumerate(elements):
+                if element is item:
+                    del levels[i]
+                    del elements[i]
+                    break
+            if not elements:
+                del self.cells[cell]
+
+    def update(self, item):
+        """Called when an element has moved so we can put it in the right cells"""
+        try:
+            item, level = self.items[id(item)]
+        except KeyError:
+            return
+        self.unbin(item)
+        self.bin(item, level)
+
     def get(self, pos):
         """Return the object at a given absolute position, or None if None exist"""
-        match = [-1, None]
-        for ui, height in self.items.items():
+        try:
+            levels, elements = self.cells[self.cell(pos)]
+        except KeyError:
+            return None
+        for ui in elements:
             if pos in ui and ui.selectable():
-                if height > match[0]:
-                    match = [height, ui]
-        return match[1]
+                return ui
+        return None
 
 
 class AbsoluteBounds(object):
@@ -101,6 +163,7 @@ class UIElement(object):
         self.set_bounds(pos, tr)
         self.enabled = False
         self.dragging = None
+        self.layout_dirty = False
 
     def set_bounds(self, pos, tr):
         self.absolute.bottom_left = self.get_absolute_in_parent(pos)
@@ -109,6 +172,7 @@ class UIElement(object):
         self.bottom_left = pos
         self.top_right = tr
         self.size = tr - pos
+        self.root.update_ui_element(self)
 
     def update_position(self):
         self.set_bounds(self.bottom_left, self.top_right)
@@ -116,9 +180,25 @@ class UIElement(object):
             child_element.update_position()
 
     def set_pos(self, pos):
-        """Called by the user to update our position directly"""
+        """
+        Called by the user to update our position directly. Our own bounds change straight away, but we and our
+        children are only laid out again in the root's next layout pass
+        """
         self.set_bounds(pos, pos + self.size)
-        self.update_position()
+        self.invalidate()
+
+    def invalidate(self):
+        """Mark this element as needing update_position calling on it in the next layout pass"""
+        if not self.layout_dirty:
+            self.layout_dirty = True
+            self.root.dirty_elements.append(self)
+
+    def ancestors(self):
+        element = self.parent
+        while element is not None and element is not self.root:
+            yield element
+            element = element.parent
+        yield self.root
 
     def get_absolute(self, p):
         """
@@ -266,8 +346,30 @@ class RootElement(UIElement):
         self.active_children = UIElementList()
         self.depressed = None
         self.cheats = ()
+        self.layout_dirty = False
+        self.dirty_elements = []
         self.set_bounds(bl, tr)
 
+    def layout(self):
+        """
+        Lay out everything that's been invalidated since the last call. This runs once a frame, so any number of
+        moves to an element in a frame only cost one relayout of its subtree
+        """
+        if not self.dirty_elements:
+            return
+        dirty = self.dirty_elements
+        self.dirty_elements = []
+        # If an ancestor is being laid out too it'll get to us
+        roots = [
+            element
+            for element in dirty
+            if not any(ancestor.layout_dirty for ancestor in element.ancestors())
+        ]
+        for element in dirty:
+            element.layout_dirty = False
+        for element in roots:
+            element.update_position()
+
     def register_ui_element(self, element):
         self.active_children[element] = element.level
 
@@ -277,8 +379,11 @@ class RootElement(UIElement):
         except KeyError:
             pass
 
+    def update_ui_element(self, element):
+        self.active_children.update(element)
+
     def remove_all_ui_elements(self):
-        toremove = [child for child in self.active_children.items]
+        toremove = self.active_children.elements()
         for child in toremove:
             child.delete()
         self.active_children = UIElementList()
@@ -526,7 +631,7 @@ class Box(UIElement):
 
     def update_position(self):
         super(Box, self).update_position()
-        self.quad.set_vertices(self.absolute.bottom_left, self.absolute.top_right, drawing.constants.ui_level)
+        self.quad.set_vertices(self.absolute.bottom_left, self.absolute.top_right, drawing.constants.DrawLevels.ui)
 
     def delete(self):
         super(Box, self).delete()
@@ -558,6 +663,9 @@ class HoverableBox(Box, HoverableElement):
 class TextBox(UIElement):
     """A Screen-relative text box wraps text to a given size"""
 
+    # Only set for the kinds that draw their own text, and then it's a range from globals.text_arena
+    quad_buffer = None
+
     def __init__(
         self,
         parent,
@@ -611,6 +719,7 @@ class TextBox(UIElement):
         )
         # Do this without any kerning or padding for now, and see what it looks like
         cursor = Point(self.margin.x, -self.viewpos + 1 - row_height - self.margin.y)
+        placed = {}
         letter_sizes = [
             Point(
                 float(quad.width * self.scale * drawing.texture.global_scale) / self.absolute.size.x,
@@ -669,33 +778,49 @@ class TextBox(UIElement):
             if target_bl.y < 0 and not ignore_height:
                 # We've gone too far, no more room to write!
                 break
-            absolute_bl = self.get_absolute(target_bl)
-            absolute_tr = self.get_absolute(target_tr)
+            # Just note where it goes for now, all the vertices get written in one go at the end
+            placed[i] = (target_bl.x, target_bl.y, target_tr.x, target_tr.y)
+            cursor.x += letter_size.x
+            i += 1
+
+        # Word wrapping can go back and place a letter twice, the dict keeps the last one. Anything past where we
+        # stopped is cleared below even if it got placed earlier
+        indices = [j for j in sorted(placed) if j < i]
+        if indices:
+            placed_quads = [self.quads[j] for j in indices]
+            targets = numpy.array([placed[j] for j in indices], numpy.float32)
+            bottom_left = numpy.array((self.absolute.bottom_left.x, self.absolute.bottom_left.y), numpy.float32)
+            size = numpy.array((self.absolute.size.x, self.absolute.size.y), numpy.float32)
             self.set_letter_vertices(
-                i, absolute_bl, absolute_tr, drawing.texture.TextTypes.LEVELS[self.text_type]
+                placed_quads,
+                bottom_left + targets[:, :2] * size,
+                bottom_left + targets[:, 2:] * size,
+                drawing.texture.TextTypes.LEVELS[self.text_type],
             )
             if colour:
-                quad.set_colour(colour)
-            cursor.x += letter_size.x
-            i += 1
+                drawing.quads.set_quads_colour(placed_quads, colour)
         # For the quads that we're not using right now, set them to display nothing
-        for quad in self.quads[i:]:
-            quad.set_vertices(Point(0, 0), Point(0, 0), -10)
+        unused = self.quads[i:]
+        zeros = numpy.zeros((len(unused), 2), numpy.float32)
+        drawing.quads.set_quads_vertices(unused, zeros, zeros, -10)
         height = max([q.height for q in self.quads])
         super(TextBox, self).update_position()
 
-    def set_letter_vertices(self, index, bl, tr, textType):
-        self.quads[index].set_vertices(bl, tr, textType)
+    def set_letter_vertices(self, quads, bl, tr, textType):
+        drawing.quads.set_quads_vertices(quads, bl, tr, textType)
 
     def update_position(self):
-        """Called by the parent to tell us we need to recalculate our absolute position"""
-        super(TextBox, self).update_position()
+        """Called during layout to tell us we need to recalculate our absolute position"""
+        # position() finishes by updating the children, so only update our own bounds first rather than doing the
+        # whole subtree twice
+        self.set_bounds(self.bottom_left, self.top_right)
         self.position(self.pos, self.scale, self.colour)
 
     def set_pos(self, pos):
-        """Called by the user to update our position directly"""
+        """Called by the user to update our position directly. The text is laid out again in the next layout pass"""
         self.set_bounds(pos, pos + self.size)
-        self.position(pos, self.scale, self.colour)
+        self.pos = pos
+        self.invalidate()
 
     def set_colour(self, colour):
         self.colour = colour
@@ -707,6 +832,9 @@ class TextBox(UIElement):
         super(TextBox, self).delete()
         for quad in self.quads:
             quad.delete()
+        if self.quad_buffer is not None:
+            self.quad_buffer.delete()
+            self.quad_buffer = None
 
     def set_text(self, text, colour=None):
         enabled = self.enabled
@@ -730,7 +858,7 @@ class TextBox(UIElement):
                 q.disable()
 
     def reallocate_resources(self):
-        self.quads = [self.text_manager.letter(char, self.text_type) for char in self.text]
+        self.quads = self.text_manager.letters(self.text, self.text_type)
 
     def disable(self):
         if self.enabled:
@@ -755,10 +883,9 @@ class FaderTextBox(TextBox):
     def __hash__(self):
         return id(self)
 
-    def set_letter_vertices(self, index, bl, tr, textType):
-        self.quads[index].set_vertices(
-            bl - self.absolute.bottom_left, tr - self.absolute.bottom_left, textType
-        )
+    def set_letter_vertices(self, quads, bl, tr, textType):
+        bottom_left = numpy.array((self.absolute.bottom_left.x, self.absolute.bottom_left.y), numpy.float32)
+        drawing.quads.set_quads_vertices(quads, bl - bottom_left, tr - bottom_left, textType)
 
     def SetFade(self, start_time, end_time, end_size, end_colour):
         self.start_time = start_time
@@ -804,9 +931,9 @@ class FaderTextBox(TextBox):
                 quad.set_colour(new_colour)
 
     def reallocate_resources(self):
-        self.quad_buffer = drawing.QuadBuffer(1024)
+        self.quad_buffer = globals.text_arena.allocate(len(self.text))
         self.text_type = drawing.texture.TextTypes.CUSTOM
-        self.quads = [self.text_manager.letter(char, self.text_type, self.quad_buffer) for char in self.text]
+        self.quads = self.text_manager.letters(self.text, self.text_type, self.quad_buffer)
 
     def draw(self):
         drawing.reset_state()
@@ -845,9 +972,9 @@ class ScrollTextBox(TextBox):
         return self
 
     def reallocate_resources(self):
-        self.quad_buffer = drawing.QuadBuffer(1024)
+        self.quad_buffer = globals.text_arena.allocate(len(self.text))
         self.text_type = drawing.texture.TextTypes.CUSTOM
-        self.quads = [self.text_manager.letter(char, self.text_type, self.quad_buffer) for char in self.text]
+        self.quads = self.text_manager.letters(self.text, self.text_type, self.quad_buffer)
 
     def draw(self):
         pass
@@ -937,16 +1064,6 @@ class TextBoxButton(TextBox):
         if not self.enabled:
             self.border.disable()
 
-    def set_pos(self, pos):
-        # FIXME: This is shit. I can't be removing and adding every frame
-        reregister = self.enabled
-        if reregister:
-            self.root.remove_ui_element(self)
-        super(TextBoxButton, self).set_pos(pos)
-        self.set_vertices()
-        if reregister:
-            self.root.register_ui_element(self)
-
     def reallocate_resources(self):
         super(TextBoxButton, self).reallocate_resources()
         self.border = drawing.QuadBorder(globals.ui_buffer, line_width=self.line_width)